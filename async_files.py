@@ -0,0 +1,65 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from config import FILE_IO_WORKERS
+from file_service import file_service
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFileService:
+    """Version asincrona de FileService para usar desde los handlers.
+
+    Cada metodo de file_service se ejecuta en un pool acotado de
+    FILE_IO_WORKERS hilos, asi un listdir, un stat de muchos archivos o el
+    borrado de un archivo de varios GB no paran el bucle de eventos. El primer argumento es siempre el user_id:
+    las llamadas de un mismo usuario se ejecutan una detras de otra y en
+    el orden en que se hicieron; las de usuarios distintos, en paralelo.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=FILE_IO_WORKERS, thread_name_prefix="file-io"
+        )
+        self.user_locks = {}
+        self.stats = {"calls": 0, "running": 0}
+
+    async def run(self, user_id, func, *args, **kwargs):
+        """Ejecuta func(*args, **kwargs) en el pool, en orden para user_id."""
+        entry = self.user_locks.get(user_id)
+        if entry is None:
+            entry = self.user_locks[user_id] = {"lock": asyncio.Lock(), "users": 0}
+        entry["users"] += 1
+        try:
+            # asyncio.Lock atiende a quien espera en orden de llegada
+            async with entry["lock"]:
+                self.stats["calls"] += 1
+                self.stats["running"] += 1
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(
+                        self.executor, functools.partial(func, *args, **kwargs)
+                    )
+                finally:
+                    self.stats["running"] -= 1
+        finally:
+            entry["users"] -= 1
+            if not entry["users"]:
+                self.user_locks.pop(user_id, None)
+
+    def __getattr__(self, name):
+        method = getattr(file_service, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        async def call(user_id, *args, **kwargs):
+            return await self.run(user_id, method, user_id, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    def get_status(self):
+        return dict(self.stats, users=len(self.user_locks), workers=FILE_IO_WORKERS)
+
+
+async_files = AsyncFileService()
@@ -0,0 +1,72 @@
+"""Compara la escritura de descargas: aiofiles chunk a chunk vs disk_writer.
+
+Usa un stream falso en memoria (chunks de 1 MB como stream_media), asi
+que mide solo el coste de escritura local.
+
+Uso: python benchmarks/bench_disk_writer.py [MB]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiofiles  # noqa: E402
+from disk_writer import disk_writer  # noqa: E402
+
+CHUNK = 1024 * 1024
+
+
+async def fake_stream_media(total_mb, chunk):
+    for _ in range(total_mb):
+        await asyncio.sleep(0)
+        yield chunk
+
+
+async def write_aiofiles(path, total_mb, chunk):
+    async with aiofiles.open(path, "wb") as f:
+        async for data in fake_stream_media(total_mb, chunk):
+            await f.write(data)
+        await f.flush()
+        os.fsync(f.fileno())
+
+
+async def write_disk_writer(path, total_mb, chunk):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, total_mb * CHUNK)
+        stream = disk_writer.open_stream(fd, 0)
+        async for data in fake_stream_media(total_mb, chunk):
+            await stream.write(data)
+        await stream.flush()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def measure(name, func, path, total_mb, chunk):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    asyncio.run(func(path, total_mb, chunk))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    gb = total_mb / 1024
+    print(f"{name:<14}{total_mb / wall:>10.1f}{cpu / gb:>14.2f}")
+    os.remove(path)
+
+
+def main():
+    total_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    chunk = os.urandom(CHUNK)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.bin")
+        print(f"Escribiendo {total_mb} MB en {tmp}")
+        print(f"{'modo':<14}{'MB/s':>10}{'CPU s / GB':>14}")
+        measure("aiofiles", write_aiofiles, path, total_mb, chunk)
+        measure("disk_writer", write_disk_writer, path, total_mb, chunk)
+
+
+if __name__ == "__main__":
+    main()
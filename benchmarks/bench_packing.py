@@ -0,0 +1,49 @@
+"""Compara tiempo y tamaño del empaquetado: stored, deflate y auto.
+
+Uso: python benchmarks/bench_packing.py [MB_POR_TIPO]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from packing_service import packing_service  # noqa: E402
+
+
+def _make_dataset(directory, mb_per_kind):
+    size = mb_per_kind * 1024 * 1024
+    # Medio ya comprimido (simulado con bytes aleatorios y firma mp4)
+    with open(os.path.join(directory, "video.mp4"), "wb") as f:
+        f.write(b"\x00\x00\x00\x18ftypmp42")
+        f.write(os.urandom(size))
+    # Binario aleatorio sin firma
+    with open(os.path.join(directory, "random.bin"), "wb") as f:
+        f.write(os.urandom(size))
+    # Texto muy comprimible
+    line = b"2024-01-01 12:00:00 INFO servicio de descarga iniciado correctamente\n"
+    with open(os.path.join(directory, "server.log"), "wb") as f:
+        f.write(line * (size // len(line)))
+    return sorted(os.listdir(directory))
+
+
+def main():
+    mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as out:
+        files = _make_dataset(src, mb)
+        print(f"Dataset: {len(files)} archivos, {mb} MB por tipo")
+        print(f"{'modo':<10}{'tiempo (s)':>12}{'tamaño (MB)':>14}")
+        for mode in ("stored", "deflate", "auto"):
+            packing_service.compression_mode = mode
+            packing_service._compression_cache.clear()
+            output = os.path.join(out, f"{mode}.zip")
+            start = time.perf_counter()
+            packing_service._write_zip(output, src, files)
+            elapsed = time.perf_counter() - start
+            size_mb = os.path.getsize(output) / (1024 * 1024)
+            print(f"{mode:<10}{elapsed:>12.2f}{size_mb:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
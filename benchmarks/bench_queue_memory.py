@@ -0,0 +1,117 @@
+"""Memoria del estado por usuario: colas de Message vs DownloadJob.
+
+Simula USUARIOS usuarios; una parte tiene archivos en cola y el resto
+solo dejo sesion y lock. "antes" guarda Message de Pyrogram en la cola y
+conserva todo; "despues" guarda DownloadJob y expulsa a los inactivos
+con la misma funcion que usa el bot. Cada escenario corre en su propio
+proceso para que el RSS no se mezcle.
+
+Los Message se construyen a mano con sus tipos anidados (usuario, chat,
+documento); uno real recibido de Telegram pesa algo mas.
+
+Uso: python benchmarks/bench_queue_memory.py [USUARIOS] [ARCHIVOS_EN_COLA]
+"""
+import asyncio
+import gc
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psutil  # noqa: E402
+
+BUSY_FRACTION = 0.1
+
+
+def make_message(user_id, message_id):
+    from pyrogram import enums
+    from pyrogram.types import Chat, Document, Message, User
+
+    now = datetime.now()
+    return Message(
+        id=message_id,
+        from_user=User(id=user_id, is_bot=False, first_name="Usuario", language_code="es"),
+        chat=Chat(id=user_id, type=enums.ChatType.PRIVATE, first_name="Usuario"),
+        date=now,
+        document=Document(
+            file_id=f"BQACAgEAAxkBAAI{user_id:012d}{message_id:06d}AAHrZ2Vk",
+            file_unique_id=f"AgAD{user_id:08d}{message_id:04d}",
+            file_name=f"archivo_{message_id}.zip",
+            mime_type="application/zip",
+            file_size=150 * 1024 * 1024,
+            date=now,
+        ),
+    )
+
+
+def build_state(scenario, users, per_user):
+    import telegram_handlers as th
+    from job_store import DownloadJob
+
+    busy = int(users * BUSY_FRACTION)
+    for user_id in range(1, users + 1):
+        th.get_session(user_id)
+        th.get_queue_lock(user_id)
+        if user_id > busy:
+            continue
+        queue = th.user_queues.setdefault(user_id, [])
+        for message_id in range(per_user):
+            message = make_message(user_id, message_id)
+            queue.append(message if scenario == "antes" else DownloadJob.from_message(message))
+
+    if scenario == "despues":
+        # Todos los inactivos superan el TTL
+        for user_id in th.user_last_seen:
+            th.user_last_seen[user_id] -= th.SESSION_IDLE_TTL
+        th._evict_idle_users(time.time())
+    return th
+
+
+def run_scenario(scenario, users, per_user):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    import telegram_handlers  # noqa: F401  (importar antes de medir)
+
+    gc.collect()
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    tracemalloc.start()
+
+    th = build_state(scenario, users, per_user)
+
+    gc.collect()
+    heap, _ = tracemalloc.get_traced_memory()
+    rss = process.memory_info().rss - rss_before
+    print(f"{rss} {heap} {len(th.user_sessions)} {len(th.user_queue_locks)}")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    print(
+        f"{users} usuarios, {int(users * BUSY_FRACTION)} con {per_user} archivo(s) en cola\n"
+    )
+    print(f"{'escenario':<10} {'RSS MB':>8} {'heap MB':>8} {'por 10k usuarios':>17} "
+          f"{'sesiones':>9} {'locks':>7}")
+
+    for scenario in ("antes", "despues"):
+        out = subprocess.run(
+            [sys.executable, __file__, "--scenario", scenario, str(users), str(per_user)],
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        rss, heap, sessions, locks = (int(x) for x in out[-4:])
+        per_10k = rss / users * 10000
+        print(
+            f"{scenario:<10} {rss / 1024 / 1024:>8.1f} {heap / 1024 / 1024:>8.1f} "
+            f"{per_10k / 1024 / 1024:>14.1f} MB {sessions:>9} {locks:>7}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--scenario":
+        run_scenario(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main()
@@ -13,18 +13,116 @@ MAX_PART_SIZE_MB = 500
 COMPRESSION_TIMEOUT = 600
 MAX_CONCURRENT_PROCESSES = 1
 CPU_USAGE_LIMIT = 80
+# Muestreo de carga en segundo plano (media movil exponencial)
+LOAD_SAMPLE_INTERVAL = 1.0
+LOAD_EWMA_ALPHA = 0.3
 
 # Tamaño maximo de archivos
 MAX_FILE_SIZE_MB = 2000
 MAX_FILE_SIZE = MAX_FILE_SIZE_MB * 1024 * 1024
 
+# Espacio en disco: margen libre minimo y cuota por usuario (0 = sin cuota)
+DISK_MIN_FREE_MB = int(os.getenv("DISK_MIN_FREE_MB", "500"))
+USER_QUOTA_MB = int(os.getenv("USER_QUOTA_MB", "0"))
+
 # Descarga
-DOWNLOAD_BUFFER_SIZE = 131072
 DOWNLOAD_THREADS = 2
 DOWNLOAD_TIMEOUT = 3600
 MAX_RETRIES = 3
 CHUNK_SIZE = 65536
 
+# Descargas en curso: fuera de downloads pero en el mismo sistema de archivos,
+# para moverlas con un rename atomico al terminar
+STAGING_DIR = os.path.join(BASE_DIR, ".staging")
+
+# Descarga segmentada (varias conexiones por archivo grande)
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))
+SEGMENTED_MIN_SIZE_MB = 64
+CHECKPOINT_INTERVAL = 2.0
+
+# Ajuste adaptativo (stream_media entrega chunks fijos de 1 MB)
+ADAPT_WINDOW = 2.0
+# Un segmento en curso solo se parte para otra conexion si le quedan
+# al menos el doble de estos chunks
+MIN_SEGMENT_CHUNKS = 16
+
+# Escritura a disco (bloques agrupados desde un hilo dedicado)
+WRITE_COALESCE_SIZE = 4 * 1024 * 1024
+WRITER_QUEUE_DEPTH = 8
+
+# Operaciones de archivos y metadatos fuera del bucle de eventos
+FILE_IO_WORKERS = int(os.getenv("FILE_IO_WORKERS", "4"))
+
+# Monitor del bucle de eventos: latido, umbral de bloqueo e histograma (ms)
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+LOOP_LAG_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LOOP_STALLS_KEPT = 20
+
+# Servir archivos mientras se descargan
+STREAM_POLL_INTERVAL = 0.25
+STREAM_STALL_TIMEOUT = 600
+# Cada respuesta que sigue una descarga ocupa un hilo de waitress mientras
+# dura: se limitan para que siempre queden hilos para el resto de peticiones
+WEB_THREADS = int(os.getenv("WEB_THREADS", "16"))
+MAX_PARTIAL_STREAMS = int(os.getenv("MAX_PARTIAL_STREAMS", str(max(1, WEB_THREADS // 2))))
+
+# Descarga bajo demanda: el enlace se entrega sin bajar el archivo
+LAZY_DOWNLOADS = os.getenv("LAZY_DOWNLOADS", "0") == "1"
+LAZY_EVICT_IDLE_HOURS = float(os.getenv("LAZY_EVICT_IDLE_HOURS", "24"))
+LAZY_EVICT_INTERVAL = 600
+
 # Cola
 MAX_QUEUE_PER_USER = 20
 QUEUE_PROCESSING_DELAY = 0.3
+JOB_DB_FILE = os.getenv("JOB_DB_FILE", "download_jobs.db")
+
+# Estado por usuario en memoria (sesiones y locks de cola)
+SESSION_IDLE_TTL = 3600
+MAX_TRACKED_USERS = 10000
+SESSION_SWEEP_INTERVAL = 60
+
+# Ediciones de mensajes de progreso (limites de Telegram)
+EDIT_CHAT_INTERVAL = 1.5
+EDIT_GLOBAL_RATE = 20
+EDIT_MAX_BACKOFF = 8.0
+BATCH_MAX_LINES = 25
+
+# Albumes: espera para agrupar sus mensajes antes de encolarlos
+ALBUM_WINDOW = 1.5
+ALBUM_DONE_TTL = 600
+
+# Planificador global de descargas
+DOWNLOAD_SLOTS = int(os.getenv("DOWNLOAD_SLOTS", "4"))
+MAX_DOWNLOADS_PER_USER = int(os.getenv("MAX_DOWNLOADS_PER_USER", "1"))
+PRIORITIZE_SMALL_FILES = os.getenv("PRIORITIZE_SMALL_FILES", "0") == "1"
+PRIORITY_MAX_WAIT = 120
+
+# Admision por recursos: capacidad en unidades de cada recurso y lo que
+# consume cada tipo de trabajo. "mem" y "space" no tienen capacidad: solo
+# se comparan con MEMORY_USAGE_LIMIT y DISK_MIN_FREE_MB (las descargas ya
+# reservan su espacio en disk_admission). Con las capacidades por defecto se
+# admite lo mismo que antes (1 empaquetado y DOWNLOAD_SLOTS descargas a la vez).
+ADMISSION_CPU_UNITS = int(os.getenv("ADMISSION_CPU_UNITS", str(MAX_CONCURRENT_PROCESSES)))
+ADMISSION_DISK_UNITS = int(os.getenv("ADMISSION_DISK_UNITS", str(DOWNLOAD_SLOTS + 2)))
+ADMISSION_NET_UNITS = int(os.getenv("ADMISSION_NET_UNITS", str(DOWNLOAD_SLOTS)))
+JOB_COSTS = {
+    "pack": {"cpu": 1, "disk": 2, "mem": 1, "space": 1},
+    "download": {"net": 1, "disk": 1},
+}
+MEMORY_USAGE_LIMIT = 90
+DISK_WRITE_BUDGET_MBPS = float(os.getenv("DISK_WRITE_BUDGET_MBPS", "0"))
+
+# Cola de empaquetados: turno por usuario y estimacion de inicio con el
+# ritmo medido (MB/s de entrada); hasta la primera medida se usa el de defecto
+PACK_DEFAULT_MBPS = float(os.getenv("PACK_DEFAULT_MBPS", "20"))
+PACK_THROUGHPUT_ALPHA = 0.3
+PACK_QUEUE_UPDATE_INTERVAL = 5.0
+
+# Compresion adaptativa al empaquetar (auto | stored | deflate)
+PACK_COMPRESSION = os.getenv("PACK_COMPRESSION", "auto")
+COMPRESSION_LEVEL = 6
+COMPRESSION_SAMPLE_BLOCKS = 4
+COMPRESSION_SAMPLE_SIZE = 16384
+COMPRESSION_ENTROPY_THRESHOLD = 7.2
+COMPRESSION_CACHE_SIZE = 4096
@@ -0,0 +1,99 @@
+import logging
+import os
+import threading
+from config import BASE_DIR, DISK_MIN_FREE_MB, USER_QUOTA_MB
+from file_service import file_service
+
+logger = logging.getLogger(__name__)
+
+
+class DiskAdmission:
+    """Reserva espacio en disco para cada archivo antes de encolarlo.
+
+    Cada reserva ocupa el tamaño declarado por Telegram hasta que la
+    descarga preasigna el archivo con posix_fallocate (a partir de ahi ya
+    cuenta en statvfs y en el uso del usuario) y se libera al terminar,
+    fallar o cancelarse. Si no se pudo preasignar (archivo disperso o
+    reanudado) sigue contando como pendiente hasta el final.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reservations = {}
+
+    def _disk_free(self):
+        os.makedirs(BASE_DIR, exist_ok=True)
+        st = os.statvfs(BASE_DIR)
+        return st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+    def _pending_bytes(self, user_id=None):
+        """Bytes reservados que aun no estan en disco."""
+        return sum(
+            r["size"] for r in self.reservations.values()
+            if not r["allocated"] and (user_id is None or r["user_id"] == user_id)
+        )
+
+    def reserve(self, user_id, key, size, force=False):
+        """Reserva size bytes. Devuelve (admitido, motivo, creada).
+
+        creada es False si key ya estaba reservada: la reserva es de otro
+        trabajo y solo este debe liberarla.
+        """
+        # Recorrer las carpetas del usuario es lento: se mide fuera del lock,
+        # que solo protege las cuentas y el diccionario de reservas
+        if not force:
+            free, _ = self._disk_free()
+            usage = file_service.get_user_storage_usage(user_id) if USER_QUOTA_MB > 0 else 0
+        with self.lock:
+            if key in self.reservations:
+                return True, None, False
+
+            if not force:
+                available = free - self._pending_bytes() - DISK_MIN_FREE_MB * 1024 * 1024
+                if size > available:
+                    return False, (
+                        f"No hay espacio suficiente en el servidor "
+                        f"(libre: {file_service.format_bytes(max(0, available))})"
+                    ), False
+
+                if USER_QUOTA_MB > 0:
+                    quota = USER_QUOTA_MB * 1024 * 1024
+                    used = usage + self._pending_bytes(user_id)
+                    if used + size > quota:
+                        return False, (
+                            f"Superarias tu cuota de {USER_QUOTA_MB} MB "
+                            f"(en uso: {file_service.format_bytes(used)})"
+                        ), False
+
+            self.reservations[key] = {"user_id": user_id, "size": size, "allocated": False}
+            return True, None, True
+
+    def mark_allocated(self, key):
+        """La descarga empezo y preasigno el archivo: ya cuenta en disco."""
+        with self.lock:
+            if key in self.reservations:
+                self.reservations[key]["allocated"] = True
+
+    def release(self, key):
+        with self.lock:
+            self.reservations.pop(key, None)
+
+    def get_status(self):
+        free, total = self._disk_free()
+        with self.lock:
+            pending = self._pending_bytes()
+            in_progress = sum(r["size"] for r in self.reservations.values() if r["allocated"])
+            count = len(self.reservations)
+        return {
+            "total_mb": round(total / 1024 / 1024, 1),
+            "free_mb": round(free / 1024 / 1024, 1),
+            "used_mb": round((total - free) / 1024 / 1024, 1),
+            "reserved_mb": round(pending / 1024 / 1024, 1),
+            "downloading_mb": round(in_progress / 1024 / 1024, 1),
+            "reservations": count,
+            "min_free_mb": DISK_MIN_FREE_MB,
+            "user_quota_mb": USER_QUOTA_MB,
+        }
+
+
+disk_admission = DiskAdmission()
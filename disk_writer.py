@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+from config import WRITE_COALESCE_SIZE, WRITER_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class WriteStream:
+    """Escritura secuencial desde un offset, agrupada en bloques grandes.
+
+    Los chunks se guardan tal cual (sin copiarlos a un buffer comun) y se
+    envian juntos al hilo escritor cuando suman WRITE_COALESCE_SIZE, o al
+    llamar a flush().
+    """
+
+    def __init__(self, writer, fd, offset, on_written=None):
+        self.writer = writer
+        self.fd = fd
+        self.start = offset
+        self.offset = offset
+        self.written = offset
+        self.on_written = on_written
+        self.buffer = []
+        self.buffered = 0
+        self.pending = set()
+        self.error = None
+
+    async def write(self, chunk):
+        if self.error:
+            raise self.error
+        self.buffer.append(chunk)
+        self.buffered += len(chunk)
+        if self.buffered >= WRITE_COALESCE_SIZE:
+            await self._submit()
+
+    async def flush(self):
+        """Envia lo acumulado y espera a que todo este escrito."""
+        await self._submit()
+        if self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+        if self.error:
+            raise self.error
+
+    async def _submit(self):
+        if not self.buffer:
+            return
+        data, size, offset = self.buffer, self.buffered, self.offset
+        self.buffer = []
+        self.buffered = 0
+        self.offset += size
+        future = await self.writer.submit(self.fd, offset, data)
+        self.pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        self.pending.discard(future)
+        if future.cancelled():
+            return
+        if future.exception():
+            if not self.error:
+                self.error = future.exception()
+            return
+        # El hilo escritor procesa en orden: todo hasta aqui ya esta en disco
+        self.written = max(self.written, future.result())
+        if self.on_written:
+            self.on_written(self)
+
+
+class DiskWriter:
+    """Hilo dedicado que escribe cada bloque de chunks con un solo pwritev.
+
+    La cola esta acotada a WRITER_QUEUE_DEPTH bloques: si el disco va mas
+    lento que la red, submit() espera y frena al lector de Telegram.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=WRITER_QUEUE_DEPTH)
+        self.thread = None
+        self.slots = None
+        self.lock = threading.Lock()
+        self.stats = {"writes": 0, "bytes": 0}
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name="disk-writer", daemon=True
+                )
+                self.thread.start()
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(WRITER_QUEUE_DEPTH)
+
+    def open_stream(self, fd, offset=0, on_written=None):
+        return WriteStream(self, fd, offset, on_written)
+
+    async def submit(self, fd, offset, data):
+        """Encola una escritura; el future devuelto se resuelve con el offset final."""
+        self._ensure_started()
+        await self.slots.acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done(exc, end=None):
+            loop.call_soon_threadsafe(self._complete, future, exc, end)
+
+        self.queue.put_nowait((fd, offset, data, done))
+        return future
+
+    def _complete(self, future, exc, end):
+        self.slots.release()
+        if future.done():
+            return
+        if exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(end)
+
+    def _run(self):
+        while True:
+            fd, offset, data, done = self.queue.get()
+            try:
+                size = sum(len(chunk) for chunk in data)
+                written = os.pwritev(fd, data, offset)
+                if written < size:
+                    # Escritura parcial (poco habitual): completar lo que falta
+                    rest = memoryview(b"".join(data))[written:]
+                    while rest:
+                        n = os.pwrite(fd, rest, offset + written)
+                        written += n
+                        rest = rest[n:]
+                offset += written
+                self.stats["writes"] += 1
+                self.stats["bytes"] += size
+                done(None, offset)
+            except Exception as e:
+                logger.error(f"Error escribiendo en disco: {e}")
+                done(e)
+
+
+disk_writer = DiskWriter()
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from config import (
+    DOWNLOAD_SLOTS,
+    MAX_DOWNLOADS_PER_USER,
+    PRIORITIZE_SMALL_FILES,
+    PRIORITY_MAX_WAIT,
+)
+from load_manager import load_manager
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadScheduler:
+    """Reparte un numero fijo de slots de descarga entre todos los usuarios.
+
+    Los slots se asignan por turnos (round-robin) entre los usuarios con
+    descargas en espera, respetando el limite de descargas simultaneas por
+    usuario. Opcionalmente se adelantan los archivos pequeños, salvo que
+    algun archivo lleve esperando mas de PRIORITY_MAX_WAIT segundos.
+    Cada slot ademas ocupa la capacidad de un trabajo "download" en
+    load_manager: si no cabe, la cola espera a que se libere.
+    """
+
+    job_type = "download"
+    label = "Descarga"
+
+    def __init__(self):
+        self.max_slots = DOWNLOAD_SLOTS
+        self.per_user = MAX_DOWNLOADS_PER_USER
+        self.prioritize_small = PRIORITIZE_SMALL_FILES
+        self.in_use = 0
+        self.active = {}
+        self.waiting = {}
+        self.turns = deque()
+        self.stats = {"granted": 0, "total_wait": 0.0, "max_wait": 0.0}
+        self.loop = None
+
+    @asynccontextmanager
+    async def slot(self, user_id, size=0):
+        """Espera un slot libre y lo libera al salir. Devuelve la espera en segundos."""
+        waited = await self.acquire(user_id, size)
+        try:
+            yield waited
+        finally:
+            self.release(user_id)
+
+    async def acquire(self, user_id, size=0):
+        waiter = self.enqueue(user_id, size)
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            self.withdraw(user_id, waiter)
+            raise
+
+        waited = time.time() - waiter["since"]
+        if waited >= 1:
+            logger.info(f"{self.label} de user {user_id} espero {waited:.1f}s por un slot")
+        return waited
+
+    def enqueue(self, user_id, size=0):
+        """Pone en cola sin esperar. El "future" del waiter se resuelve al asignar el slot."""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            load_manager.add_listener(self._on_capacity)
+        waiter = {"size": size, "since": time.time(), "future": self.loop.create_future()}
+        self.waiting.setdefault(user_id, []).append(waiter)
+        if user_id not in self.turns:
+            self.turns.append(user_id)
+        self._dispatch()
+        return waiter
+
+    def withdraw(self, user_id, waiter):
+        """Abandona la espera; si el slot ya se habia asignado, lo devuelve."""
+        future = waiter["future"]
+        if future.done() and not future.cancelled():
+            self.release(user_id)
+        else:
+            self._remove_waiter(user_id, waiter)
+            future.cancel()
+
+    def _on_capacity(self):
+        """load_manager avisa desde otro hilo: se reparte en el bucle de eventos."""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._dispatch)
+
+    def release(self, user_id):
+        load_manager.release(self.job_type)
+        self.in_use = max(0, self.in_use - 1)
+        count = self.active.get(user_id, 0) - 1
+        if count > 0:
+            self.active[user_id] = count
+        else:
+            self.active.pop(user_id, None)
+        self._dispatch()
+
+    def _grant(self, user_id, waiter):
+        self.in_use += 1
+        self.active[user_id] = self.active.get(user_id, 0) + 1
+        waited = time.time() - waiter["since"]
+        self.stats["granted"] += 1
+        self.stats["total_wait"] += waited
+        self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+
+    def _remove_waiter(self, user_id, waiter):
+        waiters = self.waiting.get(user_id, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            self.waiting.pop(user_id, None)
+            if user_id in self.turns:
+                self.turns.remove(user_id)
+
+    def _next_waiter(self):
+        """Elige (user_id, waiter) segun turno, o el mas pequeño si esta activado."""
+        eligible = [uid for uid in self.turns if self.active.get(uid, 0) < self.per_user]
+        if not eligible:
+            return None, None
+
+        if self.prioritize_small:
+            now = time.time()
+            candidates = [(uid, w) for uid in eligible for w in self.waiting[uid]]
+            starving = [c for c in candidates if now - c[1]["since"] >= PRIORITY_MAX_WAIT]
+            if starving:
+                return min(starving, key=lambda c: c[1]["since"])
+            return min(candidates, key=lambda c: c[1]["size"])
+
+        user_id = eligible[0]
+        return user_id, self.waiting[user_id][0]
+
+    def _dispatch(self):
+        while self.in_use < self.max_slots:
+            user_id, waiter = self._next_waiter()
+            if user_id is None:
+                return
+
+            if waiter["future"].done():
+                self._remove_waiter(user_id, waiter)
+                continue
+            # Sin capacidad (red, disco, CPU): se reintenta al liberarse
+            admitted, _ = load_manager.try_acquire(self.job_type)
+            if not admitted:
+                return
+
+            self._remove_waiter(user_id, waiter)
+            # El usuario atendido pasa al final del turno
+            if user_id in self.turns:
+                self.turns.remove(user_id)
+                self.turns.append(user_id)
+
+            self._grant(user_id, waiter)
+            waiter["future"].set_result(True)
+
+    def get_status(self):
+        now = time.time()
+        waits = [now - w["since"] for ws in list(self.waiting.values()) for w in ws]
+        granted = self.stats["granted"]
+        return {
+            "slots_in_use": self.in_use,
+            "max_slots": self.max_slots,
+            "per_user_limit": self.per_user,
+            "active_users": len(self.active),
+            "waiting": len(waits),
+            "oldest_wait_s": round(max(waits), 1) if waits else 0.0,
+            "avg_wait_s": round(self.stats["total_wait"] / granted, 2) if granted else 0.0,
+            "max_wait_s": round(self.stats["max_wait"], 1),
+        }
+
+
+download_scheduler = DownloadScheduler()
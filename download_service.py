@@ -1,57 +1,183 @@
 import asyncio
+import json
+import math
 import os
 import time
 import logging
 import aiofiles
 from pyrogram.errors import FloodWait
-from config import DOWNLOAD_BUFFER_SIZE, DOWNLOAD_TIMEOUT, MAX_RETRIES
+from disk_writer import disk_writer
+from disk_admission import disk_admission
+from job_store import DownloadJob
+from config import (
+    DOWNLOAD_TIMEOUT,
+    MAX_RETRIES,
+    DOWNLOAD_SEGMENTS,
+    SEGMENTED_MIN_SIZE_MB,
+    CHECKPOINT_INTERVAL,
+    ADAPT_WINDOW,
+    MIN_SEGMENT_CHUNKS,
+)
 
 logger = logging.getLogger(__name__)
 
+# Tamaño fijo de cada chunk que entrega stream_media (offset y limit van en chunks)
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class AdaptiveController:
+    """Ajusta en caliente el paralelismo de una descarga.
+
+    Pyrogram entrega siempre chunks de 1 MB y cada llamada a stream_media
+    abre su propia sesion de medios, asi que lo unico que se ajusta es
+    cuantos streams van en paralelo. Cada ADAPT_WINDOW segundos compara
+    el throughput con la ventana anterior y sigue subiendo o bajando el
+    paralelismo mientras mejore (hill climbing).
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = min(2, self.max_concurrency)
+        self.direction = 1
+        self.last_throughput = None
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_chunks = 0
+        self.throughput = 0.0
+        self.latency = 0.0
+
+    def record(self, nbytes, latency):
+        self.window_bytes += nbytes
+        self.window_latency += latency
+        self.window_chunks += 1
+
+    def maybe_adjust(self):
+        elapsed = time.time() - self.window_start
+        if elapsed < ADAPT_WINDOW or not self.window_chunks:
+            return
+
+        self.throughput = self.window_bytes / elapsed
+        self.latency = self.window_latency / self.window_chunks
+
+        if self.max_concurrency > 1:
+            if self.last_throughput is None or self.throughput >= self.last_throughput * 1.05:
+                step = self.direction
+            elif self.throughput <= self.last_throughput * 0.95:
+                self.direction = -self.direction
+                step = self.direction
+            else:
+                step = 0
+            self.concurrency = max(1, min(self.max_concurrency, self.concurrency + step))
+
+        logger.debug(
+            f"Descarga adaptativa: {self.throughput / 1024 / 1024:.1f} MB/s, "
+            f"latencia {self.latency * 1000:.0f} ms -> paralelismo {self.concurrency}"
+        )
+        self.last_throughput = self.throughput
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_chunks = 0
+
+    def summary(self):
+        return {
+            "concurrency": self.concurrency,
+            "max_concurrency": self.max_concurrency,
+            "throughput_mbps": round(self.throughput / 1024 / 1024, 2),
+            "chunk_latency_ms": round(self.latency * 1000, 1),
+        }
+
 
 class DownloadService:
     def __init__(self):
         self.active_downloads = {}
+        self.last_tuning = None
+        # Archivos en descarga que ya pueden servirse por HTTP, por ruta absoluta
+        self.partials = {}
+
+    # ── Archivos en curso (servicio mientras se descargan) ──
+
+    def begin_partial(self, file_path, file_size):
+        """Anuncia un archivo que se puede servir antes de terminar de bajarlo.
+
+        Si ya se anuncio al encolarlo se conserva la entrada: las respuestas
+        que ya la siguen veran el progreso.
+        """
+        if file_size <= 0:
+            return
+        self.partials.setdefault(os.path.abspath(file_path), {
+            "size": file_size,
+            "available": 0,
+            "status": "pending",
+        })
+
+    def end_partial(self, file_path, success):
+        entry = self.partials.pop(os.path.abspath(file_path), None)
+        if entry:
+            entry["status"] = "done" if success else "failed"
+            if success:
+                entry["available"] = entry["size"]
 
-    def _get_file_obj(self, message):
-        """Extrae el objeto de archivo y su tamaño del mensaje."""
-        if message.document:
-            return message.document, message.document.file_size or 0
-        if message.video:
-            return message.video, message.video.file_size or 0
-        if message.audio:
-            return message.audio, message.audio.file_size or 0
-        if message.photo:
-            return message.photo[-1], message.photo[-1].file_size or 0
-        return None, 0
-
-    async def download_file(self, client, message, file_path, progress_callback=None):
-        """Descarga un archivo con buffer optimizado."""
+    def get_partial(self, file_path):
+        """Estado de un archivo en descarga, o None si ya esta completo."""
+        return self.partials.get(os.path.abspath(file_path))
+
+    async def download_file(self, client, job, file_path, progress_callback=None):
+        """Descarga el archivo de un DownloadJob con buffer optimizado.
+
+        Si una descarga anterior dejo un checkpoint valido, continua desde
+        el ultimo chunk escrito en lugar de empezar de cero.
+        """
+        user_id = job.user_id
         try:
-            user_id = message.from_user.id
             self.active_downloads[user_id] = True
 
-            file_obj, file_size = self._get_file_obj(message)
-            if not file_obj:
-                raise ValueError("No se pudo obtener el objeto de archivo")
+            while True:
+                try:
+                    return await self._download_once(
+                        client, job, file_path, progress_callback
+                    )
+                except FloodWait as e:
+                    logger.warning(f"FloodWait: esperando {e.value}s")
+                    await asyncio.sleep(e.value + 1)
+
+        except Exception as e:
+            logger.error(f"Error en descarga: {e}", exc_info=True)
+            return False, 0
+
+        finally:
+            self.active_downloads.pop(user_id, None)
 
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    async def _download_once(self, client, job, file_path, progress_callback=None):
+        file_size = job.file_size
+        if not job.file_id:
+            raise ValueError("El trabajo no tiene file_id")
 
-            timeout = DOWNLOAD_TIMEOUT
-            if file_size > 500 * 1024 * 1024:
-                timeout = 7200
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-            logger.info(
-                f"Descarga iniciada: {os.path.basename(file_path)} "
-                f"({file_size / 1024 / 1024:.1f} MB)"
-            )
+        timeout = DOWNLOAD_TIMEOUT
+        if file_size > 500 * 1024 * 1024:
+            timeout = 7200
+
+        logger.info(
+            f"Descarga iniciada: {os.path.basename(file_path)} "
+            f"({file_size / 1024 / 1024:.1f} MB)"
+        )
 
-            start_time = time.time()
-            downloaded = 0
-            last_cb = start_time
+        start_time = time.time()
+        downloaded = 0
+        last_cb = start_time
 
+        if file_size > 0:
+            max_concurrency = self._segment_count(client, file_size)
+            downloaded = await self._download_segmented(
+                client, job, file_path, max_concurrency, progress_callback
+            )
+        else:
+            # Tamaño desconocido: descarga secuencial sin checkpoint
             async with aiofiles.open(file_path, "wb") as f:
-                async for chunk in client.stream_media(file_obj, limit=DOWNLOAD_BUFFER_SIZE):
+                async for chunk in client.stream_media(job.file_id):
                     if not chunk:
                         continue
 
@@ -63,36 +189,328 @@ class DownloadService:
                         await progress_callback(downloaded, file_size)
                         last_cb = now
 
-                if progress_callback and downloaded > 0:
-                    await progress_callback(downloaded, file_size)
+        # Todo en disco antes de que el archivo pase a downloads
+        await asyncio.get_running_loop().run_in_executor(None, self._sync_file, file_path)
+
+        if progress_callback and downloaded > 0:
+            await progress_callback(downloaded, file_size)
+
+        elapsed = time.time() - start_time
+        speed = downloaded / elapsed if elapsed > 0 else 0
+        logger.info(
+            f"Descarga completada: {os.path.basename(file_path)} "
+            f"en {elapsed:.1f}s ({speed / 1024 / 1024:.1f} MB/s)"
+        )
+
+        return True, downloaded
+
+    # ── Checkpoints ─────────────────────────────
+
+    @staticmethod
+    def _checkpoint_path(file_path):
+        return f"{file_path}.ckpt"
+
+    def _load_checkpoint(self, file_path, job):
+        """Valida el archivo parcial y devuelve su checkpoint.
+
+        Solo se acepta si corresponde al mismo archivo de Telegram y el
+        archivo en disco conserva el tamaño preasignado.
+        """
+        ckpt_path = self._checkpoint_path(file_path)
+        if not os.path.exists(ckpt_path):
+            return None
+        try:
+            with open(ckpt_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            valid = (
+                job.file_unique_id is not None
+                and checkpoint.get("file_unique_id") == job.file_unique_id
+                and checkpoint.get("size") == job.file_size
+                and os.path.exists(file_path)
+                and os.path.getsize(file_path) == job.file_size
+            )
+        except Exception as e:
+            logger.warning(f"Checkpoint ilegible {ckpt_path}: {e}")
+            valid = False
+
+        if not valid:
+            self.discard_checkpoint(file_path)
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, file_path, checkpoint, fd):
+        """Sincroniza los datos escritos y despues guarda el checkpoint."""
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+        ckpt_path = self._checkpoint_path(file_path)
+        tmp_path = f"{ckpt_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, ckpt_path)
 
-            elapsed = time.time() - start_time
-            speed = downloaded / elapsed if elapsed > 0 else 0
+    @staticmethod
+    def _sync_file(file_path):
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def discard_checkpoint(self, file_path):
+        try:
+            os.remove(self._checkpoint_path(file_path))
+        except FileNotFoundError:
+            pass
+
+    # ── Descarga segmentada ─────────────────────
+
+    def _segment_count(self, client, file_size):
+        """Maximo de peticiones en paralelo, limitado por max_concurrent_transmissions."""
+        if file_size < SEGMENTED_MIN_SIZE_MB * 1024 * 1024:
+            return 1
+        max_transmissions = getattr(client, "max_concurrent_transmissions", 1) or 1
+        chunks = math.ceil(file_size / STREAM_CHUNK_SIZE)
+        return max(1, min(DOWNLOAD_SEGMENTS, max_transmissions, chunks))
+
+    @staticmethod
+    def _preallocate(fd, size):
+        """Reserva el tamaño final en disco para evitar fragmentacion.
+
+        Devuelve True si los bloques quedaron asignados; con ftruncate el
+        archivo es disperso y el espacio aun no cuenta en statvfs.
+        """
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return True
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+            return False
+
+    async def _download_segmented(self, client, job, file_path, max_concurrency,
+                                  progress_callback=None):
+        """Descarga el archivo por rangos de chunks y los escribe en su offset.
+
+        Cada segmento es [chunk_inicial, cantidad, chunks_completados] y se
+        baja con una sola llamada a stream_media. AdaptiveController decide
+        cuantos streams van en paralelo; para abrir uno mas se parte por la
+        mitad el segmento en curso al que mas le queda, y el stream original
+        se detiene al llegar al nuevo limite. Al reanudar solo se piden los
+        chunks que faltan. Las escrituras pasan por disk_writer.
+        """
+        loop = asyncio.get_running_loop()
+        file_size = job.file_size
+        checkpoint = self._load_checkpoint(file_path, job)
+        partial = self.get_partial(file_path)
+
+        if checkpoint:
+            ranges = checkpoint["segments"]
+            fd = os.open(file_path, os.O_WRONLY)
+        else:
+            total_chunks = math.ceil(file_size / STREAM_CHUNK_SIZE)
+            ranges = [[0, total_chunks, 0]]
+            checkpoint = {
+                "file_unique_id": job.file_unique_id,
+                "size": file_size,
+                "segments": ranges,
+            }
+            if partial is not None:
+                # Se empieza de cero: nada de lo anterior es valido para servir
+                partial["available"] = 0
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        # Rangos ya en disco al empezar: [inicio, fin) en bytes. El ultimo
+        # chunk del archivo es mas corto: el fin se recorta a file_size
+        written_spans = [
+            (seg[0] * STREAM_CHUNK_SIZE, min((seg[0] + seg[2]) * STREAM_CHUNK_SIZE, file_size))
+            for seg in ranges if seg[2]
+        ]
+        resumed = sum(end - begin for begin, end in written_spans)
+        if resumed:
             logger.info(
-                f"Descarga completada: {os.path.basename(file_path)} "
-                f"en {elapsed:.1f}s ({speed / 1024 / 1024:.1f} MB/s)"
+                f"Reanudando {os.path.basename(file_path)} desde "
+                f"{resumed / 1024 / 1024:.1f} MB"
             )
+        state = {
+            "downloaded": resumed,
+            "last_cb": time.time(),
+            "last_ckpt": time.time(),
+            "saving": False,
+        }
+        controller = AdaptiveController(max_concurrency)
+        claimed = set()
+        streams = []
 
-            return True, downloaded
+        def update_available(_stream=None):
+            """Avanza los bytes contiguos desde el inicio que ya estan en disco."""
+            if partial is None:
+                return
+            spans = written_spans + [(st.start, st.written) for st in streams]
+            available = 0
+            for begin, end in sorted(spans):
+                if begin > available:
+                    break
+                available = max(available, end)
+            partial["available"] = min(available, file_size)
 
-        except FloodWait as e:
-            logger.warning(f"FloodWait: esperando {e.value}s")
-            await asyncio.sleep(e.value + 1)
-            return await self.download_file(client, message, file_path, progress_callback)
+        def claim():
+            """Reserva un segmento libre o parte el segmento en curso mas largo."""
+            for seg in ranges:
+                if id(seg) not in claimed and seg[2] < seg[1]:
+                    claimed.add(id(seg))
+                    return seg
+            running = [seg for seg in ranges if id(seg) in claimed]
+            if not running:
+                return None
+            seg = max(running, key=lambda s: s[1] - s[2])
+            remaining = seg[1] - seg[2]
+            if remaining < 2 * MIN_SEGMENT_CHUNKS:
+                return None
+            # La segunda mitad pasa a un stream nuevo; el actual para en keep
+            keep = seg[2] + remaining // 2
+            new_seg = [seg[0] + keep, seg[1] - keep, 0]
+            seg[1] = keep
+            ranges.append(new_seg)
+            claimed.add(id(new_seg))
+            return new_seg
 
-        except Exception as e:
-            logger.error(f"Error en descarga: {e}", exc_info=True)
-            return False, 0
+        async def flush_and_snapshot():
+            """Escribe lo acumulado y devuelve el checkpoint que ya esta en disco."""
+            snapshot = dict(checkpoint, segments=[list(seg) for seg in ranges])
+            await asyncio.gather(*(stream.flush() for stream in streams))
+            return snapshot
 
+        async def save_checkpoint():
+            if state["saving"]:
+                return
+            state["saving"] = True
+            try:
+                snapshot = await flush_and_snapshot()
+                await loop.run_in_executor(
+                    None, self._save_checkpoint, file_path, snapshot, fd
+                )
+            finally:
+                state["saving"] = False
+
+        async def fetch(segment):
+            start_chunk, chunk_count, done = segment
+            stream = disk_writer.open_stream(
+                fd, (start_chunk + done) * STREAM_CHUNK_SIZE, update_available
+            )
+            streams.append(stream)
+            last_chunk_at = time.time()
+            chunks = client.stream_media(
+                job.file_id, limit=chunk_count - done, offset=start_chunk + done
+            )
+            try:
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    if segment[2] >= segment[1]:
+                        # claim() acorto el segmento: el resto lo baja otro stream
+                        break
+                    await stream.write(chunk)
+                    segment[2] += 1
+                    state["downloaded"] += len(chunk)
+
+                    now = time.time()
+                    controller.record(len(chunk), now - last_chunk_at)
+                    last_chunk_at = now
+                    if now - state["last_ckpt"] >= CHECKPOINT_INTERVAL:
+                        state["last_ckpt"] = now
+                        await save_checkpoint()
+                    if progress_callback and now - state["last_cb"] >= 0.5:
+                        state["last_cb"] = now
+                        await progress_callback(state["downloaded"], file_size)
+            finally:
+                # Cerrar la sesion de medios tambien al cortar el stream
+                await chunks.aclose()
+            await stream.flush()
+            claimed.discard(id(segment))
+            if segment[2] < segment[1]:
+                # Pyrogram corta el generador sin error (file_reference caducada,
+                # FloodWait largo): se cuenta como intento fallido, no se reclama
+                raise IOError(
+                    f"stream_media termino antes de tiempo "
+                    f"({segment[2]} de {segment[1]} chunks del segmento)"
+                )
+
+        workers = set()
+        try:
+            if not resumed:
+                if self._preallocate(fd, file_size):
+                    # Ya ocupa su espacio en disco: deja de contar como pendiente
+                    disk_admission.mark_allocated(job.key)
+                await save_checkpoint()
+            if partial is not None:
+                partial["status"] = "downloading"
+                update_available()
+            try:
+                while True:
+                    while len(workers) < controller.concurrency:
+                        segment = claim()
+                        if segment is None:
+                            break
+                        workers.add(asyncio.ensure_future(fetch(segment)))
+                    if not workers:
+                        break
+                    done, workers = await asyncio.wait(
+                        workers, timeout=ADAPT_WINDOW, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        task.result()
+                    controller.maybe_adjust()
+            except BaseException:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                # Guardar lo completado para que el reintento continue desde aqui
+                try:
+                    snapshot = await flush_and_snapshot()
+                    await loop.run_in_executor(
+                        None, self._save_checkpoint, file_path, snapshot, fd
+                    )
+                except Exception as e:
+                    logger.warning(f"No se pudo guardar el checkpoint: {e}")
+                    self.discard_checkpoint(file_path)
+                raise
         finally:
-            self.active_downloads.pop(user_id, None)
+            # No cerrar el descriptor con escrituras pendientes en el hilo escritor
+            await asyncio.gather(
+                *(future for stream in streams for future in list(stream.pending)),
+                return_exceptions=True,
+            )
+            os.close(fd)
+
+        self.last_tuning = controller.summary()
+        logger.info(
+            f"Ajuste de descarga: {self.last_tuning['concurrency']} streams en paralelo, "
+            f"{self.last_tuning['throughput_mbps']:.1f} MB/s, "
+            f"latencia por chunk {self.last_tuning['chunk_latency_ms']:.0f} ms"
+        )
+
+        if state["downloaded"] != file_size:
+            raise IOError(
+                f"Descarga incompleta: {state['downloaded']} de {file_size} bytes"
+            )
+        self.discard_checkpoint(file_path)
+        return state["downloaded"]
 
-    async def download_with_retry(self, client, message, file_path, progress_callback=None):
+    def get_metrics(self):
+        return {
+            "active_downloads": len(self.active_downloads),
+            "last_tuning": self.last_tuning,
+        }
+
+    async def download_with_retry(self, client, job, file_path, progress_callback=None):
         """Descarga con reintentos automaticos."""
         for attempt in range(MAX_RETRIES + 1):
             try:
+                if attempt:
+                    await self._refresh_file_id(client, job)
                 success, downloaded = await self.download_file(
-                    client, message, file_path, progress_callback
+                    client, job, file_path, progress_callback
                 )
                 if success:
                     return True, downloaded
@@ -107,7 +525,20 @@ class DownloadService:
                 if attempt < MAX_RETRIES:
                     await asyncio.sleep(2 ** attempt)
 
+        self.discard_checkpoint(file_path)
         return False, 0
 
+    @staticmethod
+    async def _refresh_file_id(client, job):
+        """Renueva el file_id del trabajo antes de reintentar: su file_reference caduca."""
+        try:
+            message = await client.get_messages(job.chat_id, job.message_id)
+            fresh = DownloadJob.from_message(message) if message and not message.empty else None
+        except Exception as e:
+            logger.debug(f"No se pudo renovar el file_id de {job.message_id}: {e}")
+            return
+        if fresh is not None and fresh.file_unique_id == job.file_unique_id:
+            job.file_id = fresh.file_id
+
 
 download_service = DownloadService()
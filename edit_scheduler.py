@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from pyrogram.errors import FloodWait, MessageNotModified
+from config import EDIT_CHAT_INTERVAL, EDIT_GLOBAL_RATE, EDIT_MAX_BACKOFF
+
+logger = logging.getLogger(__name__)
+
+
+class EditScheduler:
+    """Envia las ediciones de mensajes de progreso con limite de ritmo.
+
+    Las peticiones para un mismo mensaje se fusionan: solo se envia el
+    ultimo texto. Se respeta un intervalo minimo por chat y un ritmo
+    global; tras un FloodWait se pausa todo y el intervalo por chat se
+    alarga, volviendo poco a poco al normal con cada edicion correcta.
+    Las descargas nunca esperan por estas ediciones.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.last_sent = OrderedDict()
+        self.chat_next = {}
+        self.global_next = 0.0
+        self.paused_until = 0.0
+        self.backoff = 1.0
+        self.wakeup = None
+        self.task = None
+        self.stats = {"sent": 0, "merged": 0, "skipped": 0, "flood_waits": 0, "failed": 0}
+
+    def _ensure_started(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def request(self, message, text, **kwargs):
+        """Programa una edicion sin esperar. Devuelve un future (True si se envio).
+
+        Si ya habia una edicion pendiente para el mensaje se sustituye su
+        texto y se devuelve el mismo future.
+        """
+        key = (message.chat.id, message.id)
+        loop = asyncio.get_running_loop()
+        entry = self.pending.get(key)
+        if entry:
+            entry["text"], entry["kwargs"] = text, kwargs
+            self.stats["merged"] += 1
+            return entry["future"]
+
+        if self.last_sent.get(key) == text:
+            self.stats["skipped"] += 1
+            future = loop.create_future()
+            future.set_result(True)
+            return future
+
+        entry = {
+            "message": message,
+            "text": text,
+            "kwargs": kwargs,
+            "since": time.monotonic(),
+            "future": loop.create_future(),
+        }
+        self.pending[key] = entry
+        self._ensure_started()
+        self.wakeup.set()
+        return entry["future"]
+
+    async def edit(self, message, text, **kwargs):
+        """Edicion que hay que entregar (p. ej. el resultado final): espera al envio."""
+        return await self.request(message, text, **kwargs)
+
+    def finish(self, message, text, **kwargs):
+        """Ultima edicion de un mensaje sin esperarla: se olvida al enviarse.
+
+        Para los workers de descarga, que no deben quedarse parados durante
+        una pausa por FloodWait.
+        """
+        future = self.request(message, text, **kwargs)
+        future.add_done_callback(lambda _f: self.forget(message))
+        return future
+
+    def forget(self, message):
+        """Descarta el estado de un mensaje que ya no se va a editar."""
+        self.last_sent.pop((message.chat.id, message.id), None)
+
+    def _next_ready(self, now):
+        """(clave, momento en que se puede enviar) de la proxima edicion."""
+        best = None
+        for key, entry in self.pending.items():
+            ready_at = max(self.chat_next.get(key[0], 0.0), entry["since"])
+            if best is None or ready_at < best[1]:
+                best = (key, ready_at)
+        key, ready_at = best
+        return key, max(ready_at, self.global_next, self.paused_until)
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            key, ready_at = self._next_ready(now)
+            if ready_at > now:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), ready_at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = self.pending.pop(key)
+            self.global_next = now + 1.0 / EDIT_GLOBAL_RATE
+            self.chat_next[key[0]] = now + EDIT_CHAT_INTERVAL * self.backoff
+            await self._send(key, entry)
+
+            if len(self.chat_next) > 1000:
+                self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+
+    async def _send(self, key, entry):
+        result = False
+        try:
+            await entry["message"].edit_text(entry["text"], **entry["kwargs"])
+            result = True
+            self.stats["sent"] += 1
+            self.backoff = max(1.0, self.backoff * 0.9)
+        except MessageNotModified:
+            result = True
+        except FloodWait as e:
+            self.stats["flood_waits"] += 1
+            self.paused_until = time.monotonic() + e.value
+            self.backoff = min(EDIT_MAX_BACKOFF, self.backoff * 2)
+            logger.warning(
+                f"FloodWait en ediciones: pausa de {e.value}s, "
+                f"intervalo por chat x{self.backoff:.1f}"
+            )
+            if key not in self.pending:
+                # Reintentar despues de la pausa con el mismo texto
+                self.pending[key] = entry
+                return
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.debug(f"No se pudo editar el mensaje {key}: {e}")
+
+        if result:
+            self.last_sent[key] = entry["text"]
+            self.last_sent.move_to_end(key)
+            while len(self.last_sent) > 1000:
+                self.last_sent.popitem(last=False)
+        if not entry["future"].done():
+            entry["future"].set_result(result)
+
+    def get_status(self):
+        return dict(
+            self.stats,
+            pending=len(self.pending),
+            backoff=round(self.backoff, 2),
+            paused_s=round(max(0.0, self.paused_until - time.monotonic()), 1),
+        )
+
+
+edit_scheduler = EditScheduler()
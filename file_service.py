@@ -5,16 +5,26 @@ import json
 import time
 import logging
 import re
+import threading
 import unicodedata
-from config import BASE_DIR, RENDER_DOMAIN
+from config import BASE_DIR, RENDER_DOMAIN, STAGING_DIR
 
 logger = logging.getLogger(__name__)
 
 
 class FileService:
+    """Archivos de cada usuario y su metadata (numeracion, nombres, referencias).
+
+    La metadata se usa desde el bucle de eventos, el pool de async_files y
+    los hilos de empaquetado: toda lectura, modificacion y volcado a disco
+    se hace con metadata_lock. El trabajo pesado de disco (stat, borrado
+    de archivos) queda fuera del lock.
+    """
+
     def __init__(self):
         self.file_mappings = {}
         self.metadata_file = "file_metadata.json"
+        self.metadata_lock = threading.RLock()
         self._load_metadata()
 
     # ── Metadata ────────────────────────────────
@@ -31,9 +41,15 @@ class FileService:
             self.metadata = {}
 
     def _save_metadata(self):
+        """Escribe la metadata completa de forma atomica (temporal + rename)."""
+        tmp_path = f"{self.metadata_file}.tmp"
         try:
-            with open(self.metadata_file, "w", encoding="utf-8") as f:
-                json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+            with self.metadata_lock:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.metadata_file)
         except Exception as e:
             logger.error(f"Error guardando metadata: {e}")
 
@@ -41,12 +57,13 @@ class FileService:
 
     def get_next_file_number(self, user_id, file_type="downloads"):
         user_key = f"{user_id}_{file_type}"
-        if user_key not in self.metadata:
-            self.metadata[user_key] = {"next_number": 1, "files": {}}
+        with self.metadata_lock:
+            if user_key not in self.metadata:
+                self.metadata[user_key] = {"next_number": 1, "files": {}}
 
-        next_num = self.metadata[user_key]["next_number"]
-        self.metadata[user_key]["next_number"] += 1
-        self._save_metadata()
+            next_num = self.metadata[user_key]["next_number"]
+            self.metadata[user_key]["next_number"] += 1
+            self._save_metadata()
         return next_num
 
     # ── Sanitizacion ────────────────────────────
@@ -102,8 +119,10 @@ class FileService:
 
     def get_user_storage_usage(self, user_id):
         total_size = 0
-        for file_type in ("downloads", "packed"):
-            user_dir = self.get_user_directory(user_id, file_type)
+        user_dirs = [self.get_user_directory(user_id, t) for t in ("downloads", "packed")]
+        # Las descargas en curso tambien ocupan espacio del usuario
+        user_dirs.append(os.path.join(STAGING_DIR, str(user_id)))
+        for user_dir in user_dirs:
             if not os.path.exists(user_dir):
                 continue
             for f in os.listdir(user_dir):
@@ -112,6 +131,75 @@ class FileService:
                     total_size += os.path.getsize(fp)
         return total_size
 
+    # ── Staging (descargas en curso) ────────────
+
+    def get_staging_path(self, user_id, stored_name):
+        return os.path.join(STAGING_DIR, str(user_id), stored_name)
+
+    def create_staged(self, user_id, stored_name):
+        """Crea el archivo vacio en staging para apartar el stored_name."""
+        path = self.get_staging_path(user_id, stored_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab"):
+            pass
+        return path
+
+    def commit_staged(self, user_id, stored_name, original_name=None, telegram_ref=None):
+        """Pasa un archivo terminado de staging a downloads y lo registra.
+
+        El contenido ya llega sincronizado a disco; aqui se mueve con un
+        rename atomico, se sincroniza el directorio y se registra con una
+        sola escritura de metadata. Si ya estaba registrado (descarga bajo
+        demanda) solo se mueve. Devuelve el numero del archivo.
+        """
+        staged = self.get_staging_path(user_id, stored_name)
+        user_dir = self.get_user_directory(user_id, "downloads")
+        if os.path.exists(staged):
+            os.rename(staged, os.path.join(user_dir, stored_name))
+            self._fsync_dir(user_dir)
+
+        with self.metadata_lock:
+            file_number = self.get_number_by_stored_name(user_id, stored_name)
+            if file_number is None:
+                file_number = self.register_file(
+                    user_id, original_name or stored_name, stored_name, "downloads", telegram_ref
+                )
+        return file_number
+
+    def clean_staging(self, keep=()):
+        """Borra de staging todo lo que no sea de keep, pares (user_id, stored_name)."""
+        if not os.path.isdir(STAGING_DIR):
+            return 0
+        keep = {(str(user_id), name) for user_id, name in keep}
+        removed = 0
+        for user_id in os.listdir(STAGING_DIR):
+            user_dir = os.path.join(STAGING_DIR, user_id)
+            if not os.path.isdir(user_dir):
+                continue
+            for name in os.listdir(user_dir):
+                # Cada archivo va acompañado de su checkpoint (nombre.ckpt)
+                if any(
+                    name == stored or name.startswith(f"{stored}.ckpt")
+                    for uid, stored in keep if uid == user_id
+                ):
+                    continue
+                try:
+                    os.remove(os.path.join(user_dir, name))
+                    removed += 1
+                except OSError as e:
+                    logger.warning(f"No se pudo borrar {name} de staging: {e}")
+        if removed:
+            logger.info(f"Staging: {removed} archivo(s) huerfanos eliminados")
+        return removed
+
+    @staticmethod
+    def _fsync_dir(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     # ── Hash ────────────────────────────────────
 
     def create_file_hash(self, user_id, filename):
@@ -128,19 +216,31 @@ class FileService:
         files = []
         user_key = f"{user_id}_{file_type}"
 
-        if user_key in self.metadata:
+        # Copia bajo el lock; los stat se hacen despues, sin bloquear a nadie
+        with self.metadata_lock:
+            entries = [
+                (file_num, dict(file_data))
+                for file_num, file_data in self.metadata.get(user_key, {}).get("files", {}).items()
+            ]
+
+        if entries:
             existing = []
-            for file_num, file_data in self.metadata[user_key]["files"].items():
+            for file_num, file_data in entries:
                 file_path = os.path.join(user_dir, file_data["stored_name"])
-                if os.path.exists(file_path):
+                if os.path.exists(file_path) or file_data.get("telegram"):
                     existing.append((int(file_num), file_data))
 
             existing.sort(key=lambda x: x[0])
 
             for file_number, file_data in existing:
                 file_path = os.path.join(user_dir, file_data["stored_name"])
-                if os.path.isfile(file_path):
-                    size = os.path.getsize(file_path)
+                remote = not os.path.isfile(file_path)
+                if not remote or file_data.get("telegram"):
+                    # Sin copia local: se descarga de Telegram al abrir el enlace
+                    if remote:
+                        size = file_data["telegram"].get("size", 0)
+                    else:
+                        size = os.path.getsize(file_path)
                     if file_type == "downloads":
                         url = self.create_download_url(user_id, file_data["stored_name"])
                     else:
@@ -155,6 +255,7 @@ class FileService:
                             "size_mb": size / (1024 * 1024),
                             "url": url,
                             "file_type": file_type,
+                            "remote": remote,
                         }
                     )
 
@@ -162,39 +263,120 @@ class FileService:
 
     # ── Registro ────────────────────────────────
 
-    def register_file(self, user_id, original_name, stored_name, file_type="downloads"):
+    def register_file(self, user_id, original_name, stored_name, file_type="downloads",
+                      telegram_ref=None):
+        """Registra un archivo. telegram_ref permite volver a bajarlo bajo demanda."""
         user_key = f"{user_id}_{file_type}"
-        if user_key not in self.metadata:
-            self.metadata[user_key] = {"next_number": 1, "files": {}}
-
-        file_num = self.metadata[user_key]["next_number"]
-        self.metadata[user_key]["next_number"] += 1
-
-        self.metadata[user_key]["files"][str(file_num)] = {
+        entry = {
             "original_name": original_name,
             "stored_name": stored_name,
             "registered_at": time.time(),
         }
-        self._save_metadata()
+        if telegram_ref:
+            entry["telegram"] = telegram_ref
+        with self.metadata_lock:
+            if user_key not in self.metadata:
+                self.metadata[user_key] = {"next_number": 1, "files": {}}
+
+            file_num = self.metadata[user_key]["next_number"]
+            self.metadata[user_key]["next_number"] += 1
+            self.metadata[user_key]["files"][str(file_num)] = entry
+            self._save_metadata()
 
         logger.info(f"Archivo registrado: #{file_num} - {original_name} (user {user_id})")
         return file_num
 
+    def is_stored_name_used(self, user_id, stored_name, file_type="downloads"):
+        if file_type == "downloads" and os.path.exists(
+            self.get_staging_path(user_id, stored_name)
+        ):
+            return True
+        with self.metadata_lock:
+            files = self.metadata.get(f"{user_id}_{file_type}", {}).get("files", {})
+            return any(f["stored_name"] == stored_name for f in files.values())
+
+    def get_telegram_ref(self, user_id, stored_name, file_type="downloads"):
+        """Referencia de Telegram (chat_id, message_id, size) de un archivo registrado."""
+        with self.metadata_lock:
+            files = self.metadata.get(f"{user_id}_{file_type}", {}).get("files", {})
+            for file_data in files.values():
+                if file_data["stored_name"] == stored_name:
+                    return file_data.get("telegram")
+        return None
+
+    def get_number_by_stored_name(self, user_id, stored_name, file_type="downloads"):
+        with self.metadata_lock:
+            files = self.metadata.get(f"{user_id}_{file_type}", {}).get("files", {})
+            for file_num, file_data in files.items():
+                if file_data["stored_name"] == stored_name:
+                    return int(file_num)
+        return None
+
+    def unregister_file(self, user_id, stored_name, file_type="downloads"):
+        """Deshace un registro (y borra el archivo si llego a crearse)."""
+        with self.metadata_lock:
+            file_number = self.get_number_by_stored_name(user_id, stored_name, file_type)
+            if file_number is None:
+                return False
+            success, _ = self.delete_file_by_number(user_id, file_number, file_type)
+        return success
+
+    def iter_telegram_refs(self, file_type="downloads"):
+        """Recorre (user_id, stored_name) de todos los archivos con referencia."""
+        suffix = f"_{file_type}"
+        with self.metadata_lock:
+            refs = [
+                (user_key[: -len(suffix)], file_data["stored_name"])
+                for user_key, data in self.metadata.items()
+                if user_key.endswith(suffix) and isinstance(data, dict)
+                for file_data in data.get("files", {}).values()
+                if file_data.get("telegram")
+            ]
+        yield from refs
+
+    # ── Manifiesto de empaquetado ───────────────
+
+    def get_pack_manifest(self, user_id):
+        """Manifiesto del ultimo empaquetado (para el modo incremental)."""
+        with self.metadata_lock:
+            return self.metadata.get(f"{user_id}_manifest")
+
+    def save_pack_manifest(self, user_id, manifest):
+        with self.metadata_lock:
+            self.metadata[f"{user_id}_manifest"] = manifest
+            self._save_metadata()
+
+    def _forget_packed_archive(self, user_id, stored_name):
+        """Si se borra un archivo del manifiesto, su contenido ya no cuenta como empaquetado."""
+        manifest = self.metadata.get(f"{user_id}_manifest")
+        # Solo el archivo (base.zip, base.tar) o sus partes (base.zip.001);
+        # la lista .txt, el .json y el .meta4 no llevan contenido
+        if manifest and any(
+            stored_name.startswith(f"{archive}.")
+            and re.fullmatch(r"(zip|tar)(\.\d{3,})?", stored_name[len(archive) + 1:])
+            for archive in manifest.get("archives", [])
+        ):
+            del self.metadata[f"{user_id}_manifest"]
+
+    def clear_pack_manifest(self, user_id):
+        with self.metadata_lock:
+            if self.metadata.pop(f"{user_id}_manifest", None) is not None:
+                self._save_metadata()
+
     # ── Busqueda ────────────────────────────────
 
     def get_file_by_number(self, user_id, file_number, file_type="downloads"):
         user_key = f"{user_id}_{file_type}"
-        if user_key not in self.metadata:
-            return None
-
-        file_data = self.metadata[user_key]["files"].get(str(file_number))
+        with self.metadata_lock:
+            file_data = self.metadata.get(user_key, {}).get("files", {}).get(str(file_number))
+            file_data = dict(file_data) if file_data else None
         if not file_data:
             return None
 
         user_dir = self.get_user_directory(user_id, file_type)
         file_path = os.path.join(user_dir, file_data["stored_name"])
 
-        if not os.path.exists(file_path):
+        if not os.path.exists(file_path) and not file_data.get("telegram"):
             return None
 
         if file_type == "downloads":
@@ -211,20 +393,63 @@ class FileService:
             "file_type": file_type,
         }
 
+    def resolve_selection(self, user_id, spec, file_type="downloads"):
+        """Convierte una seleccion tipo "3,5-12" en la lista de stored_name.
+
+        Devuelve (stored_names, None) o (None, mensaje_de_error).
+        """
+        spans = []
+        try:
+            for token in spec.replace("#", "").split(","):
+                token = token.strip()
+                if not token:
+                    continue
+                if "-" in token:
+                    start, end = (int(x) for x in token.split("-", 1))
+                    spans.append((min(start, end), max(start, end)))
+                else:
+                    number = int(token)
+                    spans.append((number, number))
+        except ValueError:
+            return None, f"Seleccion invalida: {spec}"
+
+        if not spans:
+            return None, "La seleccion esta vacia"
+
+        by_number = {f["number"]: f for f in self.list_user_files(user_id, file_type)}
+        # Los rangos se recortan al ultimo numero existente: "1-999999999"
+        # no debe construir mil millones de enteros
+        highest = max(by_number, default=0)
+        numbers = set()
+        for start, end in spans:
+            if start > highest:
+                numbers.add(start)
+            else:
+                numbers.update(range(start, min(end, highest) + 1))
+
+        missing = sorted(n for n in numbers if n not in by_number)
+        if missing:
+            shown = ", ".join(f"#{n}" for n in missing[:10])
+            return None, f"No existen los archivos: {shown}"
+
+        return [by_number[n]["stored_name"] for n in sorted(numbers)], None
+
     def get_original_filename(self, user_id, stored_filename, file_type="downloads"):
         user_key = f"{user_id}_{file_type}"
-        if user_key not in self.metadata:
-            return stored_filename
-
-        for file_data in self.metadata[user_key]["files"].values():
-            if file_data["stored_name"] == stored_filename:
-                return file_data["original_name"]
+        with self.metadata_lock:
+            for file_data in self.metadata.get(user_key, {}).get("files", {}).values():
+                if file_data["stored_name"] == stored_filename:
+                    return file_data["original_name"]
 
         return stored_filename
 
     # ── Renombrar ───────────────────────────────
 
     def rename_file(self, user_id, file_number, new_name, file_type="downloads"):
+        with self.metadata_lock:
+            return self._rename_file(user_id, file_number, new_name, file_type)
+
+    def _rename_file(self, user_id, file_number, new_name, file_type):
         try:
             user_key = f"{user_id}_{file_type}"
             if user_key not in self.metadata:
@@ -237,7 +462,8 @@ class FileService:
             user_dir = self.get_user_directory(user_id, file_type)
             old_path = os.path.join(user_dir, file_data["stored_name"])
 
-            if not os.path.exists(old_path):
+            remote = not os.path.exists(old_path)
+            if remote and not file_data.get("telegram"):
                 return False, "Archivo fisico no encontrado", None
 
             new_name = self.sanitize_filename(new_name)
@@ -246,14 +472,18 @@ class FileService:
 
             counter = 1
             base_new = new_stored_name
-            while os.path.exists(os.path.join(user_dir, new_stored_name)):
+            while (
+                os.path.exists(os.path.join(user_dir, new_stored_name))
+                or self.is_stored_name_used(user_id, new_stored_name, file_type)
+            ):
                 name_no_ext = os.path.splitext(base_new)[0]
                 ext = os.path.splitext(base_new)[1]
                 new_stored_name = f"{name_no_ext}_{counter}{ext}"
                 counter += 1
 
             new_path = os.path.join(user_dir, new_stored_name)
-            os.rename(old_path, new_path)
+            if not remote:
+                os.rename(old_path, new_path)
 
             file_data["original_name"] = new_name
             file_data["stored_name"] = new_stored_name
@@ -275,33 +505,36 @@ class FileService:
     def delete_file_by_number(self, user_id, file_number, file_type="downloads"):
         try:
             user_key = f"{user_id}_{file_type}"
-            if user_key not in self.metadata:
-                return False, "Usuario no encontrado"
+            user_dir = self.get_user_directory(user_id, file_type)
+            with self.metadata_lock:
+                if user_key not in self.metadata:
+                    return False, "Usuario no encontrado"
 
-            file_data = self.metadata[user_key]["files"].get(str(file_number))
-            if not file_data:
-                return False, "Archivo no encontrado"
+                file_data = self.metadata[user_key]["files"].get(str(file_number))
+                if not file_data:
+                    return False, "Archivo no encontrado"
 
-            user_dir = self.get_user_directory(user_id, file_type)
-            file_path = os.path.join(user_dir, file_data["stored_name"])
+                file_path = os.path.join(user_dir, file_data["stored_name"])
+                del self.metadata[user_key]["files"][str(file_number)]
+
+                # Reasignar numeros consecutivos
+                remaining = sorted(
+                    self.metadata[user_key]["files"].items(), key=lambda x: int(x[0])
+                )
+                self.metadata[user_key]["files"] = {}
+                new_number = 1
+                for _, data in remaining:
+                    self.metadata[user_key]["files"][str(new_number)] = data
+                    new_number += 1
+                self.metadata[user_key]["next_number"] = new_number
+                if file_type == "packed":
+                    self._forget_packed_archive(user_id, file_data["stored_name"])
+                self._save_metadata()
 
+            # Borrar un archivo de varios GB puede tardar: fuera del lock
             if os.path.exists(file_path):
                 os.remove(file_path)
 
-            del self.metadata[user_key]["files"][str(file_number)]
-
-            # Reasignar numeros consecutivos
-            remaining = sorted(
-                self.metadata[user_key]["files"].items(), key=lambda x: int(x[0])
-            )
-            self.metadata[user_key]["files"] = {}
-            new_number = 1
-            for _, data in remaining:
-                self.metadata[user_key]["files"][str(new_number)] = data
-                new_number += 1
-            self.metadata[user_key]["next_number"] = new_number
-            self._save_metadata()
-
             return True, f"Archivo #{file_number} eliminado correctamente"
 
         except Exception as e:
@@ -329,9 +562,12 @@ class FileService:
                     deleted_count += 1
 
             user_key = f"{user_id}_{file_type}"
-            if user_key in self.metadata:
-                self.metadata[user_key] = {"next_number": 1, "files": {}}
-                self._save_metadata()
+            with self.metadata_lock:
+                if user_key in self.metadata:
+                    self.metadata[user_key] = {"next_number": 1, "files": {}}
+                    self._save_metadata()
+            if file_type == "packed":
+                self.clear_pack_manifest(user_id)
 
             return True, f"Se eliminaron {deleted_count} archivos de {file_type}"
 
@@ -1,13 +1,47 @@
 import os
+import threading
 import time
-from flask import Flask, send_from_directory, jsonify, render_template_string
-
-from config import BASE_DIR, RENDER_DOMAIN, MAX_FILE_SIZE_MB
+from flask import Flask, Response, send_from_directory, jsonify, render_template_string
+
+from config import (
+    BASE_DIR,
+    RENDER_DOMAIN,
+    MAX_FILE_SIZE_MB,
+    STREAM_POLL_INTERVAL,
+    STREAM_STALL_TIMEOUT,
+    MAX_PARTIAL_STREAMS,
+)
 from load_manager import load_manager
 from file_service import file_service
+from download_scheduler import download_scheduler
+from pack_scheduler import pack_scheduler
+from async_files import async_files
+from download_service import download_service
+from lazy_fetcher import lazy_fetcher
+from edit_scheduler import edit_scheduler
+from disk_admission import disk_admission
+from loop_monitor import loop_monitor
 
 app = Flask(__name__)
 
+# Respuestas que siguen una descarga en curso (cada una ocupa un hilo)
+_partial_streams = {"active": 0, "rejected": 0}
+_partial_lock = threading.Lock()
+
+
+def _acquire_stream():
+    with _partial_lock:
+        if _partial_streams["active"] >= MAX_PARTIAL_STREAMS:
+            _partial_streams["rejected"] += 1
+            return False
+        _partial_streams["active"] += 1
+        return True
+
+
+def _release_stream():
+    with _partial_lock:
+        _partial_streams["active"] = max(0, _partial_streams["active"] - 1)
+
 
 def _format_size(size):
     for unit in ["B", "KB", "MB", "GB"]:
@@ -33,6 +67,47 @@ def _directory_structure(startpath):
     return structure
 
 
+def _follow_partial(path, partial, final_path, block_size=1024 * 1024):
+    """Envia un archivo que aun se esta descargando, siguiendo lo ya escrito.
+
+    Solo se lee hasta partial["available"] (bytes contiguos en disco). Si la
+    descarga falla o se detiene mas de STREAM_STALL_TIMEOUT se corta la
+    respuesta: el cliente recibe menos bytes que el Content-Length. Si el
+    archivo ya paso de staging (path) a downloads (final_path) antes de
+    abrirlo, se lee de alli.
+    """
+    size = partial["size"]
+    sent = 0
+    last_progress = time.time()
+    f = None
+    try:
+        while sent < size:
+            if f is None:
+                for candidate in (path, final_path):
+                    try:
+                        f = open(candidate, "rb")
+                        break
+                    except FileNotFoundError:
+                        continue
+            available = partial["available"]
+            if f is not None and sent < available:
+                f.seek(sent)
+                data = f.read(min(block_size, available - sent))
+                if data:
+                    sent += len(data)
+                    last_progress = time.time()
+                    yield data
+                    continue
+            if partial["status"] == "failed":
+                return
+            if time.time() - last_progress > STREAM_STALL_TIMEOUT:
+                return
+            time.sleep(STREAM_POLL_INTERVAL)
+    finally:
+        if f is not None:
+            f.close()
+
+
 @app.route("/")
 def home():
     return f"""
@@ -190,7 +265,16 @@ def system_status():
         "service": "file2link",
         "timestamp": time.time(),
         "system_load": status,
+        "downloads": download_scheduler.get_status(),
+        "packs": pack_scheduler.get_status(),
+        "download_tuning": download_service.get_metrics(),
+        "lazy_downloads": lazy_fetcher.get_status(),
+        "progress_edits": edit_scheduler.get_status(),
+        "file_io": async_files.get_status(),
+        "event_loop": loop_monitor.get_status(),
+        "partial_streams": dict(_partial_streams, limit=MAX_PARTIAL_STREAMS),
         "storage": storage,
+        "disk": disk_admission.get_status(),
         "configuration": {
             "max_file_size_mb": MAX_FILE_SIZE_MB,
             "max_concurrent_processes": load_manager.max_processes,
@@ -198,6 +282,11 @@ def system_status():
     })
 
 
+@app.route("/metrics")
+def metrics():
+    return Response(loop_monitor.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/files")
 def file_browser():
     try:
@@ -222,6 +311,9 @@ def file_browser():
 
 @app.route("/storage/<path:path>")
 def serve_static(path):
+    # Directorios internos (p. ej. .staging): nunca se sirven
+    if any(part.startswith(".") for part in path.split("/")):
+        return jsonify({"error": "Archivo no encontrado", "path": path}), 404
     try:
         filename = os.path.basename(path)
         response = send_from_directory(BASE_DIR, path)
@@ -239,11 +331,31 @@ def serve_download(user_id, filename):
         user_dir = os.path.join(BASE_DIR, user_id, "downloads")
         if not os.path.exists(user_dir):
             return jsonify({"error": "Usuario no encontrado"}), 404
-        if not os.path.exists(os.path.join(user_dir, filename)):
-            return jsonify({"error": "Archivo no encontrado"}), 404
+
+        path = os.path.join(user_dir, filename)
+        staged = file_service.get_staging_path(user_id, filename)
+        # En downloads solo hay archivos completos; los que bajan estan en staging
+        partial = None if os.path.exists(path) else download_service.get_partial(staged)
+        if partial is None and not os.path.exists(path):
+            # Solo registrado por referencia: se baja de Telegram ahora
+            partial = lazy_fetcher.ensure(user_id, filename)
+            if partial is None and not os.path.exists(path):
+                return jsonify({"error": "Archivo no encontrado"}), 404
+        lazy_fetcher.touch(path)
 
         original = file_service.get_original_filename(user_id, filename, "downloads")
-        response = send_from_directory(user_dir, filename)
+        if partial is not None:
+            # Aun descargando: se sirve a medida que llega, con el tamaño declarado
+            if not _acquire_stream():
+                response = jsonify({"error": "Demasiadas descargas en curso, reintenta en breve"})
+                response.headers["Retry-After"] = "30"
+                return response, 503
+            response = Response(_follow_partial(staged, partial, path))
+            # Se libera al cerrar la respuesta, aunque el cliente corte antes de empezar
+            response.call_on_close(_release_stream)
+            response.headers["Content-Length"] = str(partial["size"])
+        else:
+            response = send_from_directory(user_dir, filename)
         response.headers["Content-Disposition"] = f'attachment; filename="{original}"'
         response.headers["Content-Type"] = "application/octet-stream"
         response.headers["X-Content-Type-Options"] = "nosniff"
@@ -0,0 +1,179 @@
+import logging
+import sqlite3
+import threading
+import time
+from config import JOB_DB_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadJob:
+    """Archivo en cola, sin guardar el Message de Pyrogram.
+
+    Solo conserva lo necesario para descargar (file_id) y responder en el
+    chat (chat_id, message_id); stream_media acepta el file_id directamente.
+    """
+
+    __slots__ = (
+        "user_id", "chat_id", "message_id", "file_id", "file_unique_id",
+        "file_size", "file_name", "kind", "first_name", "created_at",
+    )
+
+    ICONS = {"Documento": "📄", "Video": "🎬", "Audio": "🎵", "Foto": "🖼"}
+
+    def __init__(self, user_id, chat_id, message_id, file_id, file_unique_id,
+                 file_size, file_name, kind, first_name=None, created_at=None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
+        self.file_name = file_name
+        self.kind = kind
+        self.first_name = first_name
+        self.created_at = created_at or time.time()
+
+    @classmethod
+    def from_message(cls, message):
+        """Crea el trabajo a partir del mensaje, o None si no trae archivo."""
+        if message.document:
+            kind, media, name = "Documento", message.document, message.document.file_name or "archivo"
+        elif message.video:
+            kind, media, name = "Video", message.video, message.video.file_name or "video.mp4"
+        elif message.audio:
+            kind, media, name = "Audio", message.audio, message.audio.file_name or "audio.mp3"
+        elif message.photo:
+            kind, media, name = "Foto", message.photo, f"foto_{message.id}.jpg"
+        else:
+            return None
+        return cls(
+            user_id=message.from_user.id,
+            chat_id=message.chat.id,
+            message_id=message.id,
+            file_id=media.file_id,
+            file_unique_id=media.file_unique_id,
+            file_size=media.file_size or 0,
+            file_name=name,
+            kind=kind,
+            first_name=message.from_user.first_name,
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{key: row[key] for key in cls.__slots__})
+
+    @property
+    def key(self):
+        return (self.chat_id, self.message_id)
+
+    @property
+    def label(self):
+        return f"{self.ICONS.get(self.kind, '📎')} {self.file_name or 'sin nombre'}"
+
+
+class JobStore:
+    """Cola de descargas persistente en SQLite.
+
+    Cada fila guarda un DownloadJob mas su estado: "pending" o "active";
+    los trabajos activos guardan el stored_name para reanudar sobre el
+    mismo archivo parcial. La base se abre con el primer uso.
+    """
+
+    COLUMNS = {
+        "file_unique_id": "TEXT",
+        "kind": "TEXT",
+        "first_name": "TEXT",
+    }
+
+    def __init__(self, path=JOB_DB_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                file_id TEXT,
+                file_unique_id TEXT,
+                file_size INTEGER NOT NULL DEFAULT 0,
+                file_name TEXT,
+                kind TEXT,
+                first_name TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                stored_name TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            )"""
+        )
+        # Bases creadas antes de guardar el trabajo completo
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, sql_type in self.COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {sql_type}")
+        return conn
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            if self.conn is None:
+                self.conn = self._connect()
+            return self.conn.execute(sql, params).fetchall()
+
+    def add(self, job, stored_name=None):
+        """Guarda un trabajo pendiente; stored_name si ya tiene archivo en staging."""
+        self._execute(
+            "INSERT OR REPLACE INTO jobs "
+            "(chat_id, message_id, user_id, file_id, file_unique_id, file_size, "
+            "file_name, kind, first_name, status, stored_name, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?)",
+            (
+                job.chat_id, job.message_id, job.user_id, job.file_id,
+                job.file_unique_id, job.file_size, job.file_name, job.kind,
+                job.first_name, stored_name, job.created_at,
+            ),
+        )
+
+    def get(self, chat_id, message_id):
+        rows = self._execute(
+            "SELECT * FROM jobs WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+        )
+        return dict(rows[0]) if rows else None
+
+    def mark_active(self, chat_id, message_id, stored_name):
+        self._execute(
+            "UPDATE jobs SET status = 'active', stored_name = ? "
+            "WHERE chat_id = ? AND message_id = ?",
+            (stored_name, chat_id, message_id),
+        )
+
+    def update_file_id(self, chat_id, message_id, file_id):
+        """Guarda el file_id renovado (su file_reference caduca)."""
+        self._execute(
+            "UPDATE jobs SET file_id = ? WHERE chat_id = ? AND message_id = ?",
+            (file_id, chat_id, message_id),
+        )
+
+    def remove(self, chat_id, message_id):
+        self._execute(
+            "DELETE FROM jobs WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+        )
+
+    def all_jobs(self):
+        """Todos los trabajos, activos primero y en orden de llegada."""
+        rows = self._execute(
+            "SELECT * FROM jobs ORDER BY status = 'pending', created_at"
+        )
+        return [dict(row) for row in rows]
+
+    def count(self):
+        return self._execute("SELECT COUNT(*) FROM jobs")[0][0]
+
+
+job_store = JobStore()
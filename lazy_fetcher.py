@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from config import LAZY_DOWNLOADS, LAZY_EVICT_IDLE_HOURS, LAZY_EVICT_INTERVAL
+from file_service import file_service
+from download_service import download_service
+from download_scheduler import download_scheduler
+from job_store import DownloadJob
+from disk_admission import disk_admission
+
+logger = logging.getLogger(__name__)
+
+
+class LazyFetcher:
+    """Descarga desde Telegram los archivos registrados solo por referencia.
+
+    El servidor HTTP corre en otro hilo: ensure() programa la descarga en
+    el loop del bot con run_coroutine_threadsafe y devuelve la entrada de
+    download_service para servirla mientras llega. Varias peticiones al
+    mismo archivo comparten una unica descarga.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.loop = None
+        self.fetches = {}
+        self.last_access = {}
+        self.lock = threading.Lock()
+        self.stats = {"fetches": 0, "evicted": 0}
+
+    def attach(self, client, loop):
+        """Se llama desde el bot una vez conectado."""
+        self.client = client
+        self.loop = loop
+        if LAZY_DOWNLOADS and LAZY_EVICT_IDLE_HOURS > 0:
+            loop.create_task(self._evict_loop())
+
+    def touch(self, file_path):
+        self.last_access[os.path.abspath(file_path)] = time.time()
+
+    def ensure(self, user_id, stored_name):
+        """Inicia (o reutiliza) la descarga de un archivo sin copia local.
+
+        Devuelve la entrada de download_service a seguir, o None si el
+        archivo no tiene referencia de Telegram o el bot no esta conectado.
+        """
+        ref = file_service.get_telegram_ref(user_id, stored_name)
+        if not ref or not ref.get("size") or self.loop is None:
+            return None
+
+        # Se baja en staging y pasa a downloads al terminar
+        path = os.path.abspath(file_service.get_staging_path(user_id, stored_name))
+
+        with self.lock:
+            if path not in self.fetches:
+                download_service.begin_partial(path, ref["size"])
+                future = asyncio.run_coroutine_threadsafe(
+                    self._fetch(int(user_id), stored_name, path, ref), self.loop
+                )
+                self.fetches[path] = future
+                future.add_done_callback(lambda _f: self._forget(path))
+                self.stats["fetches"] += 1
+                logger.info(f"Descarga bajo demanda: {stored_name} (user {user_id})")
+        return download_service.get_partial(path)
+
+    async def fetch_local(self, user_id, stored_name):
+        """Baja (o espera) la copia local de un archivo. True si ya esta en downloads."""
+        final = os.path.join(file_service.get_user_directory(user_id, "downloads"), stored_name)
+        if not os.path.isfile(final):
+            self.ensure(user_id, stored_name)
+            path = os.path.abspath(file_service.get_staging_path(user_id, stored_name))
+            with self.lock:
+                future = self.fetches.get(path)
+            if future is not None:
+                await asyncio.wrap_future(future)
+        return os.path.isfile(final)
+
+    def _forget(self, path):
+        with self.lock:
+            self.fetches.pop(path, None)
+
+    async def _fetch(self, user_id, stored_name, path, ref):
+        success = False
+        key = (ref["chat_id"], ref["message_id"])
+        reserved = False
+        loop = asyncio.get_running_loop()
+        try:
+            # Se pide el mensaje de nuevo: la file_reference guardada caduca
+            message = await self.client.get_messages(ref["chat_id"], ref["message_id"])
+            job = DownloadJob.from_message(message) if message and not message.empty else None
+            if job is None:
+                raise ValueError("El mensaje original ya no existe")
+            # Misma clave que la descarga: pasa a asignada solo si se preasigna
+            ok, reason, reserved = await loop.run_in_executor(
+                None, disk_admission.reserve, user_id, key, ref["size"]
+            )
+            if not ok:
+                raise IOError(reason)
+            async with download_scheduler.slot(user_id, ref["size"]):
+                ok, _ = await download_service.download_with_retry(
+                    client=self.client, job=job, file_path=path,
+                )
+            if ok:
+                await loop.run_in_executor(
+                    None, file_service.commit_staged, user_id, stored_name
+                )
+                success = True
+        except Exception as e:
+            logger.error(f"Error en descarga bajo demanda de {path}: {e}")
+        finally:
+            # Si la clave ya estaba reservada, la reserva es de otro trabajo
+            if reserved:
+                disk_admission.release(key)
+            download_service.end_partial(path, success)
+            if not success and os.path.exists(path):
+                os.remove(path)
+
+    # ── Expulsion de archivos inactivos ─────────
+
+    async def _evict_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(LAZY_EVICT_INTERVAL)
+            try:
+                await loop.run_in_executor(None, self.evict_idle)
+            except Exception as e:
+                logger.error(f"Error expulsando archivos inactivos: {e}")
+
+    def evict_idle(self, max_idle=None):
+        """Borra la copia local de archivos con referencia que nadie pide.
+
+        El registro se mantiene: el siguiente acceso los vuelve a bajar.
+        """
+        if max_idle is None:
+            max_idle = LAZY_EVICT_IDLE_HOURS * 3600
+        now = time.time()
+        evicted = 0
+        for user_id, stored_name in file_service.iter_telegram_refs():
+            path = os.path.abspath(
+                os.path.join(file_service.get_user_directory(user_id, "downloads"), stored_name)
+            )
+            # En downloads solo hay archivos completos: los que bajan estan en staging
+            if not os.path.isfile(path):
+                continue
+            last_used = max(os.path.getmtime(path), self.last_access.get(path, 0))
+            if now - last_used < max_idle:
+                continue
+            try:
+                os.remove(path)
+                self.last_access.pop(path, None)
+                evicted += 1
+            except OSError as e:
+                logger.warning(f"No se pudo expulsar {path}: {e}")
+
+        if evicted:
+            self.stats["evicted"] += evicted
+            logger.info(f"Expulsados {evicted} archivos inactivos (quedan como referencia)")
+        return evicted
+
+    def get_status(self):
+        return {
+            "enabled": LAZY_DOWNLOADS,
+            "fetching": len(self.fetches),
+            "fetches": self.stats["fetches"],
+            "evicted": self.stats["evicted"],
+        }
+
+
+lazy_fetcher = LazyFetcher()
@@ -1,55 +1,235 @@
+import os
 import threading
+import time
 import psutil
 import logging
-from config import MAX_CONCURRENT_PROCESSES, CPU_USAGE_LIMIT
+from config import (
+    BASE_DIR,
+    CPU_USAGE_LIMIT,
+    MEMORY_USAGE_LIMIT,
+    DISK_MIN_FREE_MB,
+    DISK_WRITE_BUDGET_MBPS,
+    LOAD_SAMPLE_INTERVAL,
+    LOAD_EWMA_ALPHA,
+    ADMISSION_CPU_UNITS,
+    ADMISSION_DISK_UNITS,
+    ADMISSION_NET_UNITS,
+    JOB_COSTS,
+)
 
 logger = logging.getLogger(__name__)
 
+RESOURCE_LABELS = {"cpu": "CPU", "disk": "disco", "net": "red", "mem": "memoria"}
+
 
 class LoadManager:
+    """Admision de trabajos segun los recursos que consumen y la carga del servidor.
+
+    Cada tipo de trabajo (JOB_COSTS) ocupa unidades de CPU, disco y red;
+    un trabajo entra si caben sus unidades y si la carga medida de los
+    recursos que usa esta dentro de presupuesto (CPU, memoria, escritura
+    en disco y espacio libre).
+
+    Un hilo de fondo muestrea la carga cada LOAD_SAMPLE_INTERVAL segundos
+    y la suaviza con una media movil exponencial: try_acquire() y
+    get_status() solo leen esa foto y no bloquean el bucle de eventos.
+    """
+
     def __init__(self):
-        self.active_processes = 0
-        self.max_processes = MAX_CONCURRENT_PROCESSES
+        self.capacity = {
+            "cpu": ADMISSION_CPU_UNITS,
+            "disk": ADMISSION_DISK_UNITS,
+            "net": ADMISSION_NET_UNITS,
+        }
+        self.costs = JOB_COSTS
+        self.used = {resource: 0 for resource in self.capacity}
+        self.running = {job_type: 0 for job_type in self.costs}
+        self.max_processes = self.max_jobs("pack")
+        self.listeners = []
         self.lock = threading.Lock()
+        self.thread = None
+        self.stats = {"admitted": 0, "refused": 0}
+        self.disk_free_mb = None
+        self.snapshot = {
+            "cpu_percent": 0.0,
+            "memory_percent": 0.0,
+            "disk_read_mbps": 0.0,
+            "disk_write_mbps": 0.0,
+            "net_recv_mbps": 0.0,
+            "net_sent_mbps": 0.0,
+        }
+        self.sampled_at = 0.0
 
-    def can_start_process(self):
+    def _ensure_started(self):
         with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name="load-sampler", daemon=True
+                )
+                self.thread.start()
+
+    # ── Muestreo ────────────────────────────────
+
+    @staticmethod
+    def _counters():
+        """(bytes leidos, escritos en disco, recibidos, enviados por red)."""
+        try:
+            disk = psutil.disk_io_counters()
+        except Exception:
+            disk = None
+        try:
+            net = psutil.net_io_counters()
+        except Exception:
+            net = None
+        return (
+            disk.read_bytes if disk else 0,
+            disk.write_bytes if disk else 0,
+            net.bytes_recv if net else 0,
+            net.bytes_sent if net else 0,
+        )
+
+    def _run(self):
+        try:
+            psutil.cpu_percent(interval=None)  # La primera lectura solo fija la referencia
+        except Exception:
+            pass
+        last_counters, last_at = self._counters(), time.monotonic()
+        while True:
+            time.sleep(LOAD_SAMPLE_INTERVAL)
             try:
-                cpu_percent = psutil.cpu_percent(interval=0.5)
-            except Exception:
-                cpu_percent = 0
+                counters, now = self._counters(), time.monotonic()
+                elapsed = max(now - last_at, 1e-6)
+                rates = [
+                    max(0, new - old) / elapsed / (1024 * 1024)
+                    for new, old in zip(counters, last_counters)
+                ]
+                last_counters, last_at = counters, now
+                st = os.statvfs(BASE_DIR) if os.path.isdir(BASE_DIR) else None
+                self.disk_free_mb = st.f_bavail * st.f_frsize / (1024 * 1024) if st else None
+                self._update({
+                    "cpu_percent": psutil.cpu_percent(interval=None),
+                    "memory_percent": psutil.virtual_memory().percent,
+                    "disk_read_mbps": rates[0],
+                    "disk_write_mbps": rates[1],
+                    "net_recv_mbps": rates[2],
+                    "net_sent_mbps": rates[3],
+                })
+            except Exception as e:
+                logger.debug(f"Error muestreando la carga: {e}")
+            # Con la nueva foto puede que ya quepa algun trabajo en espera
+            self._notify()
+
+    def _update(self, sample):
+        first = self.sampled_at == 0.0
+        smoothed = {
+            key: value if first else LOAD_EWMA_ALPHA * value + (1 - LOAD_EWMA_ALPHA) * self.snapshot[key]
+            for key, value in sample.items()
+        }
+        # Se sustituye el dict entero: los lectores nunca ven una foto a medias
+        self.snapshot = smoothed
+        self.sampled_at = time.time()
 
-            if cpu_percent > CPU_USAGE_LIMIT:
-                return False, f"CPU sobrecargada ({cpu_percent:.1f}%). Intenta mas tarde."
+    # ── Admision ────────────────────────────────
 
-            if self.active_processes >= self.max_processes:
-                return False, "Ya hay un proceso en ejecucion. Espera a que termine."
+    def max_jobs(self, job_type):
+        """Cuantos trabajos de un tipo caben a la vez con el servidor vacio."""
+        return min(
+            self.capacity[resource] // weight
+            for resource, weight in self.costs[job_type].items()
+            if weight and resource in self.capacity
+        )
 
-            self.active_processes += 1
-            return True, f"Proceso iniciado (CPU: {cpu_percent:.1f}%)"
+    def _refusal(self, job_type):
+        """Motivo por el que el trabajo no cabe ahora, o None (llamar con el lock)."""
+        cost = self.costs[job_type]
+        for resource, weight in cost.items():
+            if resource not in self.capacity or not weight:
+                continue
+            if self.used[resource] + weight > self.capacity[resource]:
+                if job_type == "pack" and self.running["pack"]:
+                    return "Ya hay un proceso en ejecucion. Espera a que termine."
+                return (
+                    f"Sin capacidad de {RESOURCE_LABELS[resource]} libre "
+                    f"({self.used[resource]}/{self.capacity[resource]}). Intenta mas tarde."
+                )
 
-    def finish_process(self):
+        snapshot = self.snapshot
+        if cost.get("cpu") and snapshot["cpu_percent"] > CPU_USAGE_LIMIT:
+            return f"CPU sobrecargada ({snapshot['cpu_percent']:.1f}%). Intenta mas tarde."
+        if cost.get("mem") and snapshot["memory_percent"] > MEMORY_USAGE_LIMIT:
+            return f"Memoria al limite ({snapshot['memory_percent']:.1f}%). Intenta mas tarde."
+        if cost.get("disk") and DISK_WRITE_BUDGET_MBPS:
+            if snapshot["disk_write_mbps"] > DISK_WRITE_BUDGET_MBPS:
+                return (
+                    f"Disco saturado ({snapshot['disk_write_mbps']:.0f} MB/s). "
+                    "Intenta mas tarde."
+                )
+        if cost.get("space") and self.disk_free_mb is not None:
+            if self.disk_free_mb < DISK_MIN_FREE_MB:
+                return "No queda espacio libre en el servidor."
+        return None
+
+    def try_acquire(self, job_type):
+        """Reserva la capacidad de un trabajo sin esperar. Devuelve (True, None) o (False, motivo)."""
+        self._ensure_started()
         with self.lock:
-            self.active_processes = max(0, self.active_processes - 1)
+            reason = self._refusal(job_type)
+            if reason:
+                self.stats["refused"] += 1
+                return False, reason
+            for resource, weight in self.costs[job_type].items():
+                if resource in self.capacity:
+                    self.used[resource] += weight
+            self.running[job_type] += 1
+            self.stats["admitted"] += 1
+            return True, None
 
-    def get_status(self):
+    def release(self, job_type):
         with self.lock:
+            if self.running[job_type] <= 0:
+                return
+            self.running[job_type] -= 1
+            for resource, weight in self.costs[job_type].items():
+                if resource in self.capacity:
+                    self.used[resource] = max(0, self.used[resource] - weight)
+        self._notify()
+
+    def add_listener(self, callback):
+        """callback() se llama (desde cualquier hilo) cuando puede haber capacidad nueva."""
+        self.listeners.append(callback)
+
+    def _notify(self):
+        for callback in list(self.listeners):
             try:
-                cpu_percent = psutil.cpu_percent(interval=0.5)
-                memory = psutil.virtual_memory()
-                memory_percent = memory.percent
-            except Exception:
-                cpu_percent = 0
-                memory_percent = 0
-
-            return {
-                "active_processes": self.active_processes,
-                "max_processes": self.max_processes,
-                "cpu_percent": cpu_percent,
-                "memory_percent": memory_percent,
-                "can_accept_work": self.active_processes < self.max_processes
-                and cpu_percent < CPU_USAGE_LIMIT,
+                callback()
+            except Exception as e:
+                logger.debug(f"Error avisando de capacidad libre: {e}")
+
+    @property
+    def active_processes(self):
+        return self.running["pack"]
+
+    def get_status(self):
+        self._ensure_started()
+        snapshot = self.snapshot
+        with self.lock:
+            admission = {
+                "capacity": dict(self.capacity),
+                "used": dict(self.used),
+                "running": dict(self.running),
+                "admitted": self.stats["admitted"],
+                "refused": self.stats["refused"],
             }
+            can_accept_work = self._refusal("pack") is None
+        return dict(
+            {key: round(value, 2) for key, value in snapshot.items()},
+            disk_free_mb=round(self.disk_free_mb, 1) if self.disk_free_mb is not None else None,
+            active_processes=admission["running"]["pack"],
+            max_processes=self.max_processes,
+            can_accept_work=can_accept_work,
+            admission=admission,
+            sample_age_s=round(time.time() - self.sampled_at, 1) if self.sampled_at else None,
+        )
 
 
 load_manager = LoadManager()
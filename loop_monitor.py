@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from config import (
+    LOOP_LAG_INTERVAL,
+    LOOP_LAG_THRESHOLD_MS,
+    LOOP_LAG_BUCKETS_MS,
+    LOOP_STALLS_KEPT,
+)
+
+logger = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+CO_COROUTINE = 0x80
+
+
+class LoopMonitor:
+    """Mide el retraso del bucle de eventos y detecta llamadas que lo bloquean.
+
+    Una tarea del bucle late cada LOOP_LAG_INTERVAL segundos; lo que tarda
+    de mas en despertar es el retraso, que se acumula en un histograma.
+    Un hilo vigilante comprueba el ultimo latido: si el bucle lleva mas de
+    LOOP_LAG_THRESHOLD_MS sin latir, toma la pila del hilo del bucle en ese
+    momento (la llamada sincrona que lo bloquea) y anota el handler que la
+    hizo y la funcion del proyecto donde esta parado.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self.beat_at = 0.0
+        self.beats = 0
+        self.bounds = LOOP_LAG_BUCKETS_MS
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.lag_sum_ms = 0.0
+        self.lag_count = 0
+        self.max_lag_ms = 0.0
+        self.stalls = deque(maxlen=LOOP_STALLS_KEPT)
+        self.stall_count = 0
+        self.lock = threading.Lock()
+
+    def start(self, loop=None):
+        """Empieza a vigilar el bucle (llamar desde el propio bucle)."""
+        loop = loop or asyncio.get_running_loop()
+        if self.task is not None and not self.task.done():
+            return
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.beat_at = time.monotonic()
+        self.task = loop.create_task(self._heartbeat())
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+            self.thread.start()
+        logger.info(f"Monitor del bucle activo (umbral {LOOP_LAG_THRESHOLD_MS} ms)")
+
+    # ── Latido ──────────────────────────────────
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            now = time.monotonic()
+            self._record(max(0.0, now - expected) * 1000)
+            self.beat_at = now
+            self.beats += 1
+
+    def _record(self, lag_ms):
+        index = next(
+            (i for i, bound in enumerate(self.bounds) if lag_ms <= bound), len(self.bounds)
+        )
+        with self.lock:
+            self.buckets[index] += 1
+            self.lag_sum_ms += lag_ms
+            self.lag_count += 1
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    # ── Vigilante ───────────────────────────────
+
+    def _watch(self):
+        threshold = LOOP_LAG_THRESHOLD_MS / 1000
+        captured = None
+        while True:
+            time.sleep(LOOP_LAG_INTERVAL)
+            if self.loop is None or self.loop.is_closed():
+                continue
+            beats = self.beats
+            # Sin latido desde hace un intervalo mas el umbral: el bucle esta parado
+            stalled_for = time.monotonic() - self.beat_at - LOOP_LAG_INTERVAL
+            if stalled_for < threshold or captured == beats:
+                continue
+            captured = beats
+            try:
+                self._capture(stalled_for * 1000)
+            except Exception as e:
+                logger.debug(f"No se pudo capturar la pila del bucle: {e}")
+
+    def _capture(self, lag_ms):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame)
+        handler, call = self._locate(frame)
+        stall = {
+            "at": time.time(),
+            "lag_ms": round(lag_ms, 1),
+            "handler": handler,
+            "call": call,
+            "stack": traceback.format_list(stack[-15:]),
+        }
+        with self.lock:
+            self.stalls.append(stall)
+            self.stall_count += 1
+        logger.warning(
+            f"Bucle de eventos bloqueado (>{lag_ms:.0f} ms) en {call} "
+            f"(handler: {handler})\n" + "".join(stall["stack"])
+        )
+
+    @staticmethod
+    def _locate(frame):
+        """(corrutina exterior del proyecto, funcion del proyecto mas interna) de la pila."""
+        handler = call = None
+        while frame is not None:
+            code = frame.f_code
+            if os.path.dirname(os.path.abspath(code.co_filename)) == PROJECT_DIR:
+                name = f"{os.path.splitext(os.path.basename(code.co_filename))[0]}.{code.co_name}"
+                if call is None:
+                    call = f"{name}:{frame.f_lineno}"
+                if code.co_flags & CO_COROUTINE:
+                    handler = name
+            frame = frame.f_back
+        return handler or "desconocido", call or "fuera del proyecto"
+
+    # ── Exportacion ─────────────────────────────
+
+    def get_status(self):
+        with self.lock:
+            count = self.lag_count
+            cumulative, total = {}, 0
+            for bound, hits in zip(self.bounds, self.buckets):
+                total += hits
+                cumulative[f"le_{bound}ms"] = total
+            cumulative["le_inf"] = count
+            return {
+                "running": self.task is not None and not self.task.done(),
+                "threshold_ms": LOOP_LAG_THRESHOLD_MS,
+                "samples": count,
+                "avg_lag_ms": round(self.lag_sum_ms / count, 2) if count else 0.0,
+                "max_lag_ms": round(self.max_lag_ms, 1),
+                "histogram": cumulative,
+                "stalls": self.stall_count,
+                "recent_stalls": [
+                    {key: stall[key] for key in ("at", "lag_ms", "handler", "call")}
+                    for stall in self.stalls
+                ],
+            }
+
+    def render_prometheus(self):
+        """Histograma y bloqueos en formato de texto de Prometheus."""
+        with self.lock:
+            buckets, lag_sum, count = list(self.buckets), self.lag_sum_ms, self.lag_count
+            stalls = self.stall_count
+            by_handler = {}
+            for stall in self.stalls:
+                by_handler[stall["handler"]] = by_handler.get(stall["handler"], 0) + 1
+        lines = [
+            "# HELP file2link_loop_lag_seconds Retraso del bucle de eventos en cada latido",
+            "# TYPE file2link_loop_lag_seconds histogram",
+        ]
+        total = 0
+        for bound, hits in zip(self.bounds, buckets):
+            total += hits
+            lines.append(f'file2link_loop_lag_seconds_bucket{{le="{bound / 1000:g}"}} {total}')
+        lines += [
+            f'file2link_loop_lag_seconds_bucket{{le="+Inf"}} {count}',
+            f"file2link_loop_lag_seconds_sum {lag_sum / 1000:.6f}",
+            f"file2link_loop_lag_seconds_count {count}",
+            "# HELP file2link_loop_stalls_total Bloqueos del bucle por encima del umbral",
+            "# TYPE file2link_loop_stalls_total counter",
+            f"file2link_loop_stalls_total {stalls}",
+            "# HELP file2link_loop_recent_stalls Bloqueos recientes por handler",
+            "# TYPE file2link_loop_recent_stalls gauge",
+        ]
+        for handler, hits in sorted(by_handler.items()):
+            lines.append(f'file2link_loop_recent_stalls{{handler="{handler}"}} {hits}')
+        return "\n".join(lines) + "\n"
+
+
+loop_monitor = LoopMonitor()
@@ -3,7 +3,7 @@ import logging
 import threading
 import sys
 from waitress import serve
-from config import BASE_DIR, PORT
+from config import BASE_DIR, PORT, WEB_THREADS
 from telegram_bot import TelegramBot
 from flask_app import app
 
@@ -23,7 +23,7 @@ def start_bot():
 
 def start_web():
     logger.info(f"Servidor web en puerto {PORT}")
-    serve(app, host="0.0.0.0", port=PORT)
+    serve(app, host="0.0.0.0", port=PORT, threads=WEB_THREADS)
 
 
 if __name__ == "__main__":
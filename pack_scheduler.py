@@ -0,0 +1,89 @@
+import heapq
+import logging
+import time
+from config import PACK_DEFAULT_MBPS, PACK_THROUGHPUT_ALPHA
+from download_scheduler import DownloadScheduler
+from load_manager import load_manager
+
+logger = logging.getLogger(__name__)
+
+
+class PackScheduler(DownloadScheduler):
+    """Cola de empaquetados: por turnos entre usuarios, uno por usuario a la vez.
+
+    En lugar de rechazar un empaquetado cuando no hay capacidad, espera
+    su turno y arranca solo en cuanto load_manager admite un trabajo
+    "pack". El ritmo de empaquetado (bytes de entrada por segundo) se mide
+    al terminar cada uno y sirve para estimar cuando empezara cada espera.
+    """
+
+    job_type = "pack"
+    label = "Empaquetado"
+
+    def __init__(self):
+        super().__init__()
+        self.max_slots = load_manager.max_processes
+        self.per_user = 1
+        self.prioritize_small = False
+        self.running = {}
+        self.throughput = None
+
+    def _grant(self, user_id, waiter):
+        super()._grant(user_id, waiter)
+        self.running[user_id] = {"size": waiter["size"], "started": time.time()}
+
+    def release(self, user_id, completed=False):
+        """Libera el slot; si el empaquetado termino bien, actualiza el ritmo medido."""
+        job = self.running.pop(user_id, None)
+        if completed and job and job["size"]:
+            elapsed = time.time() - job["started"]
+            # Los muy cortos (cache, pocos datos) no dicen nada del ritmo real
+            if elapsed >= 1:
+                rate = job["size"] / elapsed
+                if self.throughput is None:
+                    self.throughput = rate
+                else:
+                    self.throughput = (
+                        PACK_THROUGHPUT_ALPHA * rate + (1 - PACK_THROUGHPUT_ALPHA) * self.throughput
+                    )
+        super().release(user_id)
+
+    def _rate(self):
+        return self.throughput or PACK_DEFAULT_MBPS * 1024 * 1024
+
+    def _predicted_order(self):
+        """Esperas en el orden en que se atenderan: una por usuario y vuelta."""
+        queues = [list(self.waiting.get(uid, [])) for uid in self.turns]
+        order = []
+        while any(queues):
+            for uid, waiters in zip(list(self.turns), queues):
+                if waiters:
+                    order.append((uid, waiters.pop(0)))
+        return order
+
+    def estimate(self, waiter):
+        """(posicion en la cola, segundos hasta empezar), o (None, None) si ya no espera."""
+        rate = self._rate()
+        now = time.time()
+        # Momento en que queda libre cada slot, empezando por los ocupados
+        free_at = [
+            max(0.0, job["size"] / rate - (now - job["started"]))
+            for job in self.running.values()
+        ]
+        free_at += [0.0] * max(0, max(1, self.max_slots) - len(free_at))
+        heapq.heapify(free_at)
+        for position, (_, queued) in enumerate(self._predicted_order(), 1):
+            start = heapq.heappop(free_at)
+            if queued is waiter:
+                return position, start
+            heapq.heappush(free_at, start + queued["size"] / rate)
+        return None, None
+
+    def get_status(self):
+        status = super().get_status()
+        status["throughput_mbps"] = round(self._rate() / (1024 * 1024), 2)
+        status["measured"] = self.throughput is not None
+        return status
+
+
+pack_scheduler = PackScheduler()
@@ -1,124 +1,525 @@
 import os
+import hashlib
+import json
 import logging
+import math
+import threading
+import tarfile
 import time
 import zipfile
-from config import BASE_DIR, MAX_PART_SIZE_MB
-from load_manager import load_manager
+import zlib
+from collections import Counter, OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+from config import (
+    BASE_DIR,
+    MAX_PART_SIZE_MB,
+    PACK_COMPRESSION,
+    COMPRESSION_LEVEL,
+    COMPRESSION_SAMPLE_BLOCKS,
+    COMPRESSION_SAMPLE_SIZE,
+    COMPRESSION_ENTROPY_THRESHOLD,
+    COMPRESSION_CACHE_SIZE,
+)
 from file_service import file_service
 
 logger = logging.getLogger(__name__)
 
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Firmas de formatos que ya vienen comprimidos (offset, bytes)
+COMPRESSED_SIGNATURES = (
+    (0, b"PK\x03\x04"),          # zip, docx, apk, jar
+    (0, b"\x1f\x8b"),            # gzip
+    (0, b"BZh"),                  # bzip2
+    (0, b"\xfd7zXZ\x00"),         # xz
+    (0, b"\x28\xb5\x2f\xfd"),     # zstd
+    (0, b"7z\xbc\xaf\x27\x1c"),   # 7z
+    (0, b"Rar!\x1a\x07"),         # rar
+    (0, b"\xff\xd8\xff"),          # jpeg
+    (0, b"\x89PNG"),              # png
+    (0, b"GIF8"),                 # gif
+    (0, b"RIFF"),                 # webp, avi, wav
+    (0, b"\x1a\x45\xdf\xa3"),     # mkv, webm
+    (0, b"OggS"),                 # ogg, opus
+    (0, b"fLaC"),                 # flac
+    (0, b"ID3"),                  # mp3
+    (4, b"ftyp"),                 # mp4, mov, m4a, heic
+)
+
+
+class PackCancelled(Exception):
+    """El usuario cancelo el empaquetado en curso."""
+
 
 class PackingService:
     def __init__(self):
         self.max_part_size_mb = MAX_PART_SIZE_MB
-
-    def pack_folder(self, user_id, split_size_mb=None):
-        """Empaqueta archivos en ZIP, opcionalmente dividido en partes."""
+        self.compression_mode = PACK_COMPRESSION
+        # Decision por (ruta, mtime, tamaño), en orden LRU
+        self._compression_cache = OrderedDict()
+        self._compression_lock = threading.Lock()
+        self._result_cache = {}
+
+    def pack_folder(self, user_id, split_size_mb=None, incremental=False,
+                    selection=None, archive_format="zip", cancel_event=None):
+        """Empaqueta archivos en ZIP o TAR, opcionalmente dividido en partes.
+
+        En modo incremental solo se incluyen los archivos nuevos o
+        modificados desde el ultimo empaquetado (archivo delta).
+        Con selection (lista de stored_name) solo se empaquetan esos
+        archivos y no se modifica el manifiesto incremental.
+        Si cancel_event (threading.Event) se activa, se detiene entre
+        archivos o bloques y borra lo que haya escrito.
+
+        La capacidad de CPU y disco la reserva quien llama (pack_scheduler).
+        """
         try:
-            can_start, message = load_manager.can_start_process()
-            if not can_start:
-                return None, message
-
-            try:
-                user_dir = file_service.get_user_directory(user_id, "downloads")
-                if not os.path.exists(user_dir):
-                    return None, "No tienes archivos para empaquetar"
-
-                files = [
-                    f for f in os.listdir(user_dir)
-                    if os.path.isfile(os.path.join(user_dir, f))
-                ]
+            if selection is not None:
+                incremental = False
+            user_dir, files = self._input_files(user_id, selection)
+            if not files:
+                return None, "No tienes archivos para empaquetar"
+
+            snapshot = self._snapshot(user_dir, files)
+            cache_key = None
+            if not incremental:
+                cache_key = self._cache_key(snapshot, split_size_mb, archive_format)
+                cached = self._get_cached_result(user_id, cache_key)
+                if cached:
+                    return cached
+
+            previous = file_service.get_pack_manifest(user_id)
+            if incremental and previous:
+                files = self._changed_files(user_dir, snapshot, previous["files"])
                 if not files:
-                    return None, "No tienes archivos para empaquetar"
-
-                packed_dir = file_service.get_user_directory(user_id, "packed")
-                os.makedirs(packed_dir, exist_ok=True)
-
-                timestamp = int(time.time())
-                base_filename = f"packed_{timestamp}"
-
-                if split_size_mb:
-                    result = self._pack_and_split(
-                        user_id, user_dir, packed_dir, base_filename, split_size_mb, files
-                    )
-                else:
-                    result = self._pack_single(
-                        user_id, user_dir, packed_dir, base_filename, files
-                    )
-                return result
-
-            finally:
-                load_manager.finish_process()
+                    return None, "No hay cambios desde el ultimo empaquetado"
 
+            packed_dir = file_service.get_user_directory(user_id, "packed")
+            os.makedirs(packed_dir, exist_ok=True)
+
+            timestamp = int(time.time())
+            base_filename = f"packed_{timestamp}"
+            if incremental and previous:
+                base_filename += "_inc"
+
+            if split_size_mb:
+                parts, result_msg, crcs = self._pack_and_split(
+                    user_id, user_dir, packed_dir, base_filename, split_size_mb,
+                    files, archive_format, cancel_event,
+                )
+            else:
+                parts, result_msg, crcs = self._pack_single(
+                    user_id, user_dir, packed_dir, base_filename, files, archive_format,
+                    cancel_event,
+                )
+
+            if selection is None:
+                # Un empaquetado completo empieza una cadena nueva de archivos
+                self._update_manifest(
+                    user_id, base_filename, snapshot, previous if incremental else None, crcs
+                )
+            if cache_key:
+                self._store_cached_result(user_id, cache_key, parts, result_msg)
+            if incremental and previous:
+                result_msg = f"Incremental: {result_msg}"
+            return parts, result_msg
+
+        except PackCancelled:
+            logger.info(f"Empaquetado cancelado por el usuario {user_id}")
+            return None, "Empaquetado cancelado"
         except Exception as e:
-            load_manager.finish_process()
             logger.error(f"Error en empaquetado: {e}")
             return None, f"Error al empaquetar: {str(e)}"
 
-    def _pack_single(self, user_id, user_dir, packed_dir, base_filename, files):
-        """Crea un unico archivo ZIP sin compresion."""
-        output_file = os.path.join(packed_dir, f"{base_filename}.zip")
+    def probe(self, user_id, split_size_mb=None, incremental=False, selection=None,
+              archive_format="zip"):
+        """Mira sin empaquetar si el resultado ya esta en cache y cuanto hay que leer.
+
+        Devuelve (resultado_en_cache o None, bytes de entrada).
+        """
+        if selection is not None:
+            incremental = False
+        user_dir, files = self._input_files(user_id, selection)
+        snapshot = self._snapshot(user_dir, files)
+        size = sum(info["size"] for info in snapshot.values())
+        if incremental or not files:
+            return None, size
+        cache_key = self._cache_key(snapshot, split_size_mb, archive_format)
+        return self._get_cached_result(user_id, cache_key), size
+
+    @staticmethod
+    def _input_files(user_id, selection=None):
+        """(carpeta, archivos) de downloads que entran en el paquete."""
+        user_dir = file_service.get_user_directory(user_id, "downloads")
+        if not os.path.exists(user_dir):
+            return user_dir, []
+        files = [
+            f for f in os.listdir(user_dir)
+            if os.path.isfile(os.path.join(user_dir, f))
+        ]
+        if selection is not None:
+            selected = set(selection)
+            files = [f for f in files if f in selected]
+        return user_dir, files
+
+    # ── Cache de resultados ─────────────────────
+
+    @staticmethod
+    def _cache_key(snapshot, split_size_mb, archive_format):
+        files = tuple(
+            (name, info["size"], info["mtime"]) for name, info in sorted(snapshot.items())
+        )
+        return files, split_size_mb, archive_format
+
+    def _get_cached_result(self, user_id, cache_key):
+        """Devuelve el resultado previo si todas sus partes siguen en disco."""
+        entry = self._result_cache.get(user_id, {}).get(cache_key)
+        if not entry:
+            return None
+
+        packed = {
+            f["stored_name"]: f for f in file_service.list_user_files(user_id, "packed")
+        }
+        if not all(name in packed for name in entry["filenames"]):
+            self._result_cache[user_id].pop(cache_key, None)
+            return None
+
+        parts = []
+        for i, name in enumerate(entry["filenames"]):
+            f = packed[name]
+            parts.append({
+                "number": f["number"],
+                "filename": name,
+                "url": f["url"],
+                "size_mb": f["size_mb"],
+                "total_files": entry["total_files"] if i == 0 else 0,
+            })
+        logger.info(f"Empaquetado reutilizado de cache (user {user_id})")
+        return parts, f"{entry['message']} (ya empaquetado)"
+
+    def _store_cached_result(self, user_id, cache_key, parts, message):
+        self._result_cache.setdefault(user_id, {})[cache_key] = {
+            "filenames": [p["filename"] for p in parts],
+            "total_files": parts[0]["total_files"] if parts else 0,
+            "message": message,
+        }
+
+    def evict_cached_results(self, user_id, stored_name=None):
+        """Olvida resultados del usuario, o solo los que usan stored_name."""
+        if stored_name is None:
+            self._result_cache.pop(user_id, None)
+            return
+        entries = self._result_cache.get(user_id, {})
+        for key in [k for k, v in entries.items() if stored_name in v["filenames"]]:
+            del entries[key]
+
+    # ── Manifiesto incremental ──────────────────
+
+    @staticmethod
+    def _snapshot(user_dir, files):
+        """Tamaño y mtime actuales de cada archivo."""
+        snapshot = {}
+        for filename in files:
+            st = os.stat(os.path.join(user_dir, filename))
+            snapshot[filename] = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        return snapshot
+
+    @staticmethod
+    def _file_crc(file_path):
+        crc = 0
+        with open(file_path, "rb") as f:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+        return crc
+
+    def _changed_files(self, user_dir, snapshot, previous_files):
+        """Archivos nuevos o modificados respecto al manifiesto anterior.
+
+        Si solo cambio el mtime se compara el CRC para no reempaquetar
+        archivos que en realidad son identicos.
+        """
+        changed = []
+        for filename, info in snapshot.items():
+            prev = previous_files.get(filename)
+            if not prev or prev["size"] != info["size"]:
+                changed.append(filename)
+                continue
+            if prev["mtime"] == info["mtime"]:
+                info["crc"] = prev["crc"]
+                continue
+            if prev["crc"] is None:
+                changed.append(filename)
+                continue
+            crc = self._file_crc(os.path.join(user_dir, filename))
+            if crc != prev["crc"]:
+                changed.append(filename)
+            else:
+                info["crc"] = crc
+        return changed
+
+    def _update_manifest(self, user_id, base_filename, snapshot, previous, crcs):
+        """Guarda (nombre, tamaño, mtime, crc) de todo lo empaquetado hasta ahora."""
+        files = {}
+        for filename, info in snapshot.items():
+            if filename in crcs:
+                crc = crcs[filename]
+            elif "crc" in info:
+                crc = info["crc"]
+            else:
+                continue
+            files[filename] = {"size": info["size"], "mtime": info["mtime"], "crc": crc}
+
+        archives = previous["archives"] if previous else []
+        file_service.save_pack_manifest(user_id, {
+            "archives": archives + [base_filename],
+            "created_at": time.time(),
+            "files": files,
+        })
+
+    @staticmethod
+    def _check_cancelled(cancel_event):
+        if cancel_event is not None and cancel_event.is_set():
+            raise PackCancelled("Empaquetado cancelado")
+
+    def _write_zip(self, output_file, user_dir, files, cancel_event=None):
+        """Escribe el ZIP eligiendo STORED o DEFLATED para cada archivo.
+
+        Devuelve el CRC32 de cada miembro escrito.
+        """
+        deflated = 0
+        crcs = {}
+        with zipfile.ZipFile(output_file, "w", compression=zipfile.ZIP_STORED) as zf:
+            for filename in files:
+                self._check_cancelled(cancel_event)
+                file_path = os.path.join(user_dir, filename)
+                try:
+                    compress_type = self._choose_compression(file_path)
+                    if compress_type == zipfile.ZIP_DEFLATED:
+                        deflated += 1
+                        zf.write(
+                            file_path, filename,
+                            compress_type=compress_type, compresslevel=COMPRESSION_LEVEL,
+                        )
+                    else:
+                        zf.write(file_path, filename, compress_type=compress_type)
+                except Exception as e:
+                    logger.error(f"Error agregando {filename}: {e}")
+            for info in zf.infolist():
+                crcs[info.filename] = info.CRC
+        logger.info(f"ZIP escrito: {deflated}/{len(files)} archivos comprimidos")
+        return crcs
+
+    def _write_archive(self, output_file, user_dir, files, archive_format, cancel_event=None):
+        if archive_format == "tar":
+            return self._write_tar(output_file, user_dir, files, cancel_event)
+        return self._write_zip(output_file, user_dir, files, cancel_event)
+
+    def _write_tar(self, output_file, user_dir, files, cancel_event=None):
+        """Escribe un TAR copiando el contenido con sendfile, sin pasada de CRC.
+
+        Devuelve los miembros escritos (con CRC None, el TAR no lo guarda).
+        """
+        written = {}
+        with open(output_file, "wb", buffering=0) as out:
+            total = 0
+            for filename in files:
+                self._check_cancelled(cancel_event)
+                file_path = os.path.join(user_dir, filename)
+                try:
+                    with open(file_path, "rb", buffering=0) as src:
+                        st = os.fstat(src.fileno())
+                        info = tarfile.TarInfo(filename)
+                        info.size = st.st_size
+                        info.mtime = int(st.st_mtime)
+                        info.mode = 0o644
+                        header = info.tobuf(format=tarfile.PAX_FORMAT)
+                        out.write(header)
+                        copied = self._copy_range(src.fileno(), out.fileno(), st.st_size)
+                        # Si el archivo encogio, rellenar para mantener el TAR valido
+                        padding = (st.st_size - copied) + (-st.st_size) % tarfile.BLOCKSIZE
+                        out.write(b"\0" * padding)
+                    total += len(header) + st.st_size + (-st.st_size) % tarfile.BLOCKSIZE
+                    written[filename] = None
+                except Exception as e:
+                    logger.error(f"Error agregando {filename}: {e}")
+                    out.truncate(total)
+                    out.seek(total)
+
+            out.write(b"\0" * (tarfile.BLOCKSIZE * 2))
+            total += tarfile.BLOCKSIZE * 2
+            out.write(b"\0" * ((-total) % tarfile.RECORDSIZE))
+        logger.info(f"TAR escrito: {len(written)}/{len(files)} archivos")
+        return written
+
+    @staticmethod
+    def _copy_range(src_fd, dst_fd, size):
+        """Copia size bytes entre descriptores, con sendfile si esta disponible."""
+        copied = 0
+        try:
+            while copied < size:
+                sent = os.sendfile(dst_fd, src_fd, copied, min(size - copied, 1 << 30))
+                if sent == 0:
+                    break
+                copied += sent
+            return copied
+        except (AttributeError, OSError):
+            pass
+
+        os.lseek(src_fd, copied, os.SEEK_SET)
+        while copied < size:
+            block = os.read(src_fd, min(size - copied, 1024 * 1024))
+            if not block:
+                break
+            view = memoryview(block)
+            while view:
+                view = view[os.write(dst_fd, view):]
+            copied += len(block)
+        return copied
+
+    # ── Compresion adaptativa ───────────────────
+
+    def _choose_compression(self, file_path):
+        """Decide STORED o DEFLATED segun firma y entropia de una muestra."""
+        if self.compression_mode == "stored":
+            return zipfile.ZIP_STORED
+        if self.compression_mode == "deflate":
+            return zipfile.ZIP_DEFLATED
+
+        st = os.stat(file_path)
+        key = (file_path, st.st_mtime_ns, st.st_size)
+        with self._compression_lock:
+            cached = self._compression_cache.get(key)
+            if cached is not None:
+                self._compression_cache.move_to_end(key)
+                return cached
+
+        compress_type = zipfile.ZIP_STORED
+        if st.st_size > 0:
+            sample, header = self._sample_file(file_path, st.st_size)
+            if not self._is_compressed_format(header):
+                if self._estimate_entropy(sample) < COMPRESSION_ENTROPY_THRESHOLD:
+                    compress_type = zipfile.ZIP_DEFLATED
+
+        with self._compression_lock:
+            self._compression_cache[key] = compress_type
+            while len(self._compression_cache) > COMPRESSION_CACHE_SIZE:
+                self._compression_cache.popitem(last=False)
+        return compress_type
+
+    def _sample_file(self, file_path, size):
+        """Lee varios bloques repartidos por el archivo."""
+        block = COMPRESSION_SAMPLE_SIZE
+        blocks = COMPRESSION_SAMPLE_BLOCKS
+        with open(file_path, "rb") as f:
+            if size <= block * blocks:
+                data = f.read()
+                return data, data[:16]
+
+            header = f.read(16)
+            f.seek(0)
+            samples = []
+            step = (size - block) // (blocks - 1) if blocks > 1 else 0
+            for i in range(blocks):
+                f.seek(i * step)
+                samples.append(f.read(block))
+            return b"".join(samples), header
+
+    @staticmethod
+    def _is_compressed_format(header):
+        return any(
+            header[offset:offset + len(magic)] == magic
+            for offset, magic in COMPRESSED_SIGNATURES
+        )
+
+    @staticmethod
+    def _estimate_entropy(data):
+        """Entropia de Shannon en bits por byte (0 a 8)."""
+        if not data:
+            return 0.0
+        total = len(data)
+        entropy = 0.0
+        # Una sola pasada sobre la muestra; solo aparecen los bytes presentes
+        for count in Counter(data).values():
+            p = count / total
+            entropy -= p * math.log2(p)
+        return entropy
+
+    def _pack_single(self, user_id, user_dir, packed_dir, base_filename, files,
+                     archive_format="zip", cancel_event=None):
+        """Crea un unico archivo ZIP o TAR."""
+        archive_name = f"{base_filename}.{archive_format}"
+        output_file = os.path.join(packed_dir, archive_name)
 
         try:
-            logger.info(f"Creando ZIP con {len(files)} archivos...")
-            with zipfile.ZipFile(output_file, "w", compression=zipfile.ZIP_STORED) as zf:
-                for filename in files:
-                    try:
-                        zf.write(os.path.join(user_dir, filename), filename)
-                    except Exception as e:
-                        logger.error(f"Error agregando {filename}: {e}")
+            logger.info(f"Creando {archive_format.upper()} con {len(files)} archivos...")
+            crcs = self._write_archive(
+                output_file, user_dir, files, archive_format, cancel_event
+            )
 
             size_mb = os.path.getsize(output_file) / (1024 * 1024)
             file_num = file_service.register_file(
-                user_id, f"{base_filename}.zip", f"{base_filename}.zip", "packed"
+                user_id, archive_name, archive_name, "packed"
             )
-            url = file_service.create_packed_url(user_id, f"{base_filename}.zip")
+            url = file_service.create_packed_url(user_id, archive_name)
 
             return [
                 {
                     "number": file_num,
-                    "filename": f"{base_filename}.zip",
+                    "filename": archive_name,
                     "url": url,
                     "size_mb": size_mb,
                     "total_files": len(files),
                 }
-            ], f"Empaquetado completado: {len(files)} archivos, {size_mb:.1f} MB"
+            ], f"Empaquetado completado: {len(files)} archivos, {size_mb:.1f} MB", crcs
 
         except Exception as e:
             if os.path.exists(output_file):
                 os.remove(output_file)
             raise e
 
-    def _pack_and_split(self, user_id, user_dir, packed_dir, base_filename, split_size_mb, files):
-        """Crea ZIP y lo divide en partes."""
+    def _pack_and_split(self, user_id, user_dir, packed_dir, base_filename, split_size_mb,
+                        files, archive_format="zip", cancel_event=None):
+        """Crea ZIP o TAR y lo divide en partes."""
         split_bytes = min(split_size_mb, self.max_part_size_mb) * 1024 * 1024
-        temp_zip = os.path.join(packed_dir, f"temp_{base_filename}.zip")
+        temp_zip = os.path.join(packed_dir, f"temp_{base_filename}.{archive_format}")
+        parts = []
+        part_path = None
 
         try:
-            logger.info(f"Creando ZIP temporal con {len(files)} archivos...")
-            with zipfile.ZipFile(temp_zip, "w", compression=zipfile.ZIP_STORED) as zf:
-                for filename in files:
-                    try:
-                        zf.write(os.path.join(user_dir, filename), filename)
-                    except Exception as e:
-                        logger.error(f"Error agregando {filename}: {e}")
+            logger.info(
+                f"Creando {archive_format.upper()} temporal con {len(files)} archivos..."
+            )
+            crcs = self._write_archive(
+                temp_zip, user_dir, files, archive_format, cancel_event
+            )
 
             # Dividir en partes
-            parts = []
             part_num = 1
             with open(temp_zip, "rb") as zf:
                 while True:
-                    part_name = f"{base_filename}.zip.{part_num:03d}"
+                    part_name = f"{base_filename}.{archive_format}.{part_num:03d}"
                     part_path = os.path.join(packed_dir, part_name)
-                    chunk = zf.read(split_bytes)
-                    if not chunk:
+                    block = zf.read(min(split_bytes, COPY_BLOCK_SIZE))
+                    if not block:
                         break
 
+                    # SHA-256 calculado mientras se escribe la parte
+                    digest = hashlib.sha256()
+                    part_size = 0
                     with open(part_path, "wb") as pf:
-                        pf.write(chunk)
-
-                    part_mb = len(chunk) / (1024 * 1024)
+                        while block:
+                            self._check_cancelled(cancel_event)
+                            pf.write(block)
+                            digest.update(block)
+                            part_size += len(block)
+                            if part_size >= split_bytes:
+                                break
+                            block = zf.read(min(split_bytes - part_size, COPY_BLOCK_SIZE))
+
+                    part_mb = part_size / (1024 * 1024)
                     file_num = file_service.register_file(user_id, part_name, part_name, "packed")
                     url = file_service.create_packed_url(user_id, part_name)
 
@@ -126,7 +527,9 @@ class PackingService:
                         "number": file_num,
                         "filename": part_name,
                         "url": url,
+                        "size": part_size,
                         "size_mb": part_mb,
+                        "sha256": digest.hexdigest(),
                         "total_files": len(files) if part_num == 1 else 0,
                     })
                     logger.info(f"Parte {part_num}: {part_name} ({part_mb:.2f} MB)")
@@ -134,19 +537,27 @@ class PackingService:
 
             os.remove(temp_zip)
 
-            # Crear lista de partes
+            # Crear lista de partes y manifiestos
             self._create_parts_list(user_id, packed_dir, base_filename, parts, len(files))
+            self._create_parts_manifest(user_id, packed_dir, base_filename, parts, len(files))
+            self._create_metalink(user_id, packed_dir, base_filename, parts)
 
             total_mb = sum(p["size_mb"] for p in parts)
             return parts, (
                 f"Empaquetado completado: {len(parts)} partes, "
                 f"{len(files)} archivos, {total_mb:.1f} MB total"
-            )
+            ), crcs
 
         except Exception as e:
-            logger.error(f"Error en empaquetado dividido: {e}", exc_info=True)
+            if not isinstance(e, PackCancelled):
+                logger.error(f"Error en empaquetado dividido: {e}", exc_info=True)
             if os.path.exists(temp_zip):
                 os.remove(temp_zip)
+            # Un juego de partes incompleto no sirve: se borra lo ya escrito
+            for part in parts:
+                file_service.unregister_file(user_id, part["filename"], "packed")
+            if part_path and os.path.exists(part_path):
+                os.remove(part_path)
             raise e
 
     def _create_parts_list(self, user_id, packed_dir, base_filename, parts, total_files):
@@ -163,6 +574,7 @@ class PackingService:
                 for i, part in enumerate(parts, 1):
                     f.write(f"Parte {i:03d}: {part['filename']}\n")
                     f.write(f"Tamaño: {part['size_mb']:.2f} MB\n")
+                    f.write(f"SHA-256: {part['sha256']}\n")
                     f.write(f"Enlace: {part['url']}\n\n")
 
             file_service.register_file(user_id, list_name, list_name, "packed")
@@ -170,6 +582,57 @@ class PackingService:
         except Exception as e:
             logger.error(f"Error creando lista: {e}")
 
+    def _create_parts_manifest(self, user_id, packed_dir, base_filename, parts, total_files):
+        """Crea un .json con tamaño, SHA-256 y enlace de cada parte."""
+        manifest_name = f"{base_filename}.json"
+        manifest_path = os.path.join(packed_dir, manifest_name)
+
+        try:
+            manifest = {
+                "name": base_filename,
+                "total_files": total_files,
+                "total_size": sum(p["size"] for p in parts),
+                "parts": [
+                    {
+                        "index": i,
+                        "filename": part["filename"],
+                        "size": part["size"],
+                        "sha256": part["sha256"],
+                        "url": part["url"],
+                    }
+                    for i, part in enumerate(parts, 1)
+                ],
+            }
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+            file_service.register_file(user_id, manifest_name, manifest_name, "packed")
+            logger.info(f"Manifiesto de partes creado: {manifest_name}")
+        except Exception as e:
+            logger.error(f"Error creando manifiesto: {e}")
+
+    def _create_metalink(self, user_id, packed_dir, base_filename, parts):
+        """Crea un Metalink 4 (.meta4) para aria2 y otros gestores de descarga."""
+        metalink_name = f"{base_filename}.meta4"
+        metalink_path = os.path.join(packed_dir, metalink_name)
+
+        try:
+            with open(metalink_path, "w", encoding="utf-8") as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                f.write('<metalink xmlns="urn:ietf:params:xml:ns:metalink">\n')
+                for part in parts:
+                    f.write(f"  <file name={quoteattr(part['filename'])}>\n")
+                    f.write(f"    <size>{part['size']}</size>\n")
+                    f.write(f'    <hash type="sha-256">{part["sha256"]}</hash>\n')
+                    f.write(f"    <url>{escape(part['url'])}</url>\n")
+                    f.write("  </file>\n")
+                f.write("</metalink>\n")
+
+            file_service.register_file(user_id, metalink_name, metalink_name, "packed")
+            logger.info(f"Metalink creado: {metalink_name}")
+        except Exception as e:
+            logger.error(f"Error creando metalink: {e}")
+
     def clear_packed_folder(self, user_id):
         try:
             packed_dir = file_service.get_user_directory(user_id, "packed")
@@ -187,6 +650,8 @@ class PackingService:
                     os.remove(fp)
                     count += 1
 
+            file_service.clear_pack_manifest(user_id)
+            self.evict_cached_results(user_id)
             return True, f"Se eliminaron {count} archivos empaquetados"
         except Exception as e:
             logger.error(f"Error limpiando empaquetados: {e}")
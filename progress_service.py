@@ -17,12 +17,14 @@ class ProgressService:
         if speed <= 0 or current <= 0:
             return "calculando..."
         remaining = total - current
-        eta = remaining / speed
-        if eta < 60:
-            return f"{int(eta)}s"
-        if eta < 3600:
-            return f"{int(eta // 60)}m {int(eta % 60)}s"
-        return f"{int(eta // 3600)}h {int((eta % 3600) // 60)}m"
+        return self.format_duration(remaining / speed)
+
+    def format_duration(self, seconds):
+        if seconds < 60:
+            return f"{int(seconds)}s"
+        if seconds < 3600:
+            return f"{int(seconds // 60)}m {int(seconds % 60)}s"
+        return f"{int(seconds // 3600)}h {int((seconds % 3600) // 60)}m"
 
     def format_speed(self, speed_bytes):
         if speed_bytes <= 0:
@@ -2,7 +2,9 @@ import asyncio
 import logging
 from pyrogram import Client
 from config import API_ID, API_HASH, BOT_TOKEN
-from telegram_handlers import setup_handlers
+from telegram_handlers import setup_handlers, recover_jobs
+from lazy_fetcher import lazy_fetcher
+from loop_monitor import loop_monitor
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +16,7 @@ class TelegramBot:
 
     async def start(self):
         try:
+            loop_monitor.start(asyncio.get_running_loop())
             self.client = Client(
                 "file2link_bot",
                 api_id=API_ID,
@@ -30,6 +33,8 @@ class TelegramBot:
 
             info = await self.client.get_me()
             logger.info(f"Bot activo: @{info.username}")
+            lazy_fetcher.attach(self.client, asyncio.get_running_loop())
+            await recover_jobs(self.client)
             self.is_running = True
 
             await asyncio.Event().wait()
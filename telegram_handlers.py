@@ -2,7 +2,8 @@ import os
 import logging
 import time
 import asyncio
-import concurrent.futures
+import threading
+from collections import OrderedDict
 
 from pyrogram import Client, filters
 from pyrogram.types import (
@@ -14,10 +15,31 @@ from pyrogram.types import (
 
 from load_manager import load_manager
 from file_service import file_service
+from async_files import async_files
 from progress_service import progress_service
 from packing_service import packing_service
 from download_service import download_service
-from config import MAX_FILE_SIZE, MAX_FILE_SIZE_MB, MAX_QUEUE_PER_USER, QUEUE_PROCESSING_DELAY
+from download_scheduler import download_scheduler
+from pack_scheduler import pack_scheduler
+from job_store import job_store, DownloadJob
+from edit_scheduler import edit_scheduler
+from disk_admission import disk_admission
+from lazy_fetcher import lazy_fetcher
+from config import (
+    MAX_FILE_SIZE,
+    MAX_FILE_SIZE_MB,
+    MAX_QUEUE_PER_USER,
+    QUEUE_PROCESSING_DELAY,
+    MAX_DOWNLOADS_PER_USER,
+    LAZY_DOWNLOADS,
+    SESSION_IDLE_TTL,
+    MAX_TRACKED_USERS,
+    SESSION_SWEEP_INTERVAL,
+    BATCH_MAX_LINES,
+    ALBUM_WINDOW,
+    ALBUM_DONE_TTL,
+    PACK_QUEUE_UPDATE_INTERVAL,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -29,15 +51,75 @@ user_sessions: dict = {}
 user_queues: dict = {}
 user_queue_locks: dict = {}
 user_processing: dict = {}
+user_workers: dict = {}
+# Lote en curso por usuario: un unico mensaje de progreso para varios archivos
+user_batches: dict = {}
+# Albumes (media_group_id) en espera de agruparse y ya encolados
+album_buffers: dict = {}
+album_done: dict = {}
+# Tareas cancelables: descargas en curso (por job.key) y empaquetados (por usuario)
+active_downloads: dict = {}
+active_packs: dict = {}
+cancelled_jobs: set = set()
+# Ultimo uso por usuario, en orden LRU (el mas antiguo primero)
+user_last_seen: OrderedDict = OrderedDict()
+_last_sweep = {"at": 0.0}
+
+
+def _touch_user(user_id: int):
+    now = time.time()
+    user_last_seen[user_id] = now
+    user_last_seen.move_to_end(user_id)
+    if now - _last_sweep["at"] >= SESSION_SWEEP_INTERVAL:
+        _last_sweep["at"] = now
+        _evict_idle_users(now)
+
+
+def _user_busy(user_id: int) -> bool:
+    lock = user_queue_locks.get(user_id)
+    return bool(
+        user_queues.get(user_id)
+        or user_processing.get(user_id)
+        or user_workers.get(user_id)
+        or user_batches.get(user_id)
+        or user_id in active_packs
+        or (lock and lock.locked())
+    )
+
+
+def _evict_idle_users(now: float):
+    """Olvida sesiones y locks de usuarios inactivos.
+
+    Se expulsan los que llevan mas de SESSION_IDLE_TTL sin actividad y,
+    si aun se supera MAX_TRACKED_USERS, los menos usados. Nunca se toca
+    a un usuario con archivos en cola o en proceso.
+    """
+    excess = len(user_last_seen) - MAX_TRACKED_USERS
+    evicted = 0
+    for user_id, seen in list(user_last_seen.items()):
+        if now - seen < SESSION_IDLE_TTL and excess <= 0:
+            break
+        if _user_busy(user_id):
+            continue
+        user_last_seen.pop(user_id, None)
+        user_sessions.pop(user_id, None)
+        user_queue_locks.pop(user_id, None)
+        user_queues.pop(user_id, None)
+        excess -= 1
+        evicted += 1
+    if evicted:
+        logger.debug(f"Estado expulsado de {evicted} usuarios inactivos")
 
 
 def get_session(user_id: int) -> dict:
+    _touch_user(user_id)
     if user_id not in user_sessions:
         user_sessions[user_id] = {"current_folder": "downloads"}
     return user_sessions[user_id]
 
 
 def get_queue_lock(user_id: int) -> asyncio.Lock:
+    _touch_user(user_id)
     if user_id not in user_queue_locks:
         user_queue_locks[user_id] = asyncio.Lock()
     return user_queue_locks[user_id]
@@ -152,6 +234,26 @@ def kb_after_pack() -> InlineKeyboardMarkup:
     ])
 
 
+def kb_cancel_download(job) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(
+            "🚫 Cancelar", callback_data=f"cancel_dl:{job.chat_id}:{job.message_id}"
+        ),
+    ]])
+
+
+def kb_cancel_batch() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🚫 Cancelar lote", callback_data="cancel_batch"),
+    ]])
+
+
+def kb_cancel_pack() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🚫 Cancelar", callback_data="cancel_pack"),
+    ]])
+
+
 def kb_back() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[
         InlineKeyboardButton("📋 Ver archivos", callback_data="list:1"),
@@ -187,9 +289,13 @@ HELP = (
     "/clear — Vaciar carpeta actual\n\n"
     "**EMPAQUETADO:**\n"
     "/pack — Comprimir en ZIP\n"
-    "/pack MB — ZIP dividido en partes de N MB\n\n"
+    "/pack MB — ZIP dividido en partes de N MB\n"
+    "/pack inc [MB] — Solo archivos nuevos o modificados\n"
+    "/pack 3,5-12 [MB] — Solo los archivos indicados (uno solo: #3)\n"
+    "/pack tar [MB] — TAR en lugar de ZIP (mas rapido para videos)\n\n"
     "**COLA:**\n"
     "/queue — Ver archivos en cola\n"
+    "/cancel — Cancelar la descarga o el empaquetado en curso\n"
     "/clearqueue — Cancelar cola\n\n"
     "**INFO:**\n"
     "/status — Estado del sistema\n"
@@ -198,14 +304,16 @@ HELP = (
 )
 
 
-def _build_status(user_id: int, session: dict) -> str:
-    dl = len(file_service.list_user_files(user_id, "downloads"))
-    pk = len(file_service.list_user_files(user_id, "packed"))
-    mb = file_service.get_user_storage_usage(user_id) / (1024 * 1024)
+async def _build_status(user_id: int, session: dict) -> str:
+    dl = len(await async_files.list_user_files(user_id, "downloads"))
+    pk = len(await async_files.list_user_files(user_id, "packed"))
+    mb = await async_files.get_user_storage_usage(user_id) / (1024 * 1024)
     s = load_manager.get_status()
     icon = "🟢" if s["can_accept_work"] else "🔴"
     status = "Operativo" if s["can_accept_work"] else "Sobrecargado"
-    queue_len = len(user_queues.get(user_id, []))
+    queue_len = len(user_queues.get(user_id, [])) + len(user_processing.get(user_id, []))
+    sched = download_scheduler.get_status()
+    packs = pack_scheduler.get_status()
     return (
         f"📊 **Estado del sistema**\n\n"
         f"**Tu cuenta:**\n"
@@ -218,7 +326,12 @@ def _build_status(user_id: int, session: dict) -> str:
         f"**Servidor:**\n"
         f"  CPU: {s['cpu_percent']:.1f}%\n"
         f"  Memoria: {s['memory_percent']:.1f}%\n"
-        f"  Procesos: {s['active_processes']}/{s['max_processes']}\n"
+        f"  Disco: {s['disk_write_mbps']:.1f} MB/s escritura\n"
+        f"  Red: ↓ {s['net_recv_mbps']:.1f} MB/s  ↑ {s['net_sent_mbps']:.1f} MB/s\n"
+        f"  Procesos: {s['active_processes']}/{s['max_processes']} "
+        f"({packs['waiting']} en cola, {packs['throughput_mbps']:.1f} MB/s)\n"
+        f"  Descargas: {sched['slots_in_use']}/{sched['max_slots']} "
+        f"({sched['waiting']} en espera)\n"
         f"  Estado: {icon} {status}"
     )
 
@@ -232,13 +345,69 @@ def _build_list(files: list, folder: str, page: int, total_pages: int) -> str:
     start = (page - 1) * ITEMS_PER_PAGE
     for f in files[start : start + ITEMS_PER_PAGE]:
         lines.append(f"**#{f['number']}** {_link(f['name'], f['url'])}")
-        lines.append(f"   {f['size_mb']:.1f} MB")
+        where = "  ·  en Telegram" if f.get("remote") else ""
+        lines.append(f"   {f['size_mb']:.1f} MB{where}")
         lines.append("")
 
     lines.append("Comandos: /delete N  |  /rename N nombre")
     return "\n".join(lines)
 
 
+BATCH_ICONS = {
+    "queued": "🕒", "downloading": "⏳", "done": "✅", "failed": "❌", "cancelled": "🚫",
+}
+
+
+def _build_dashboard(batch: dict) -> str:
+    items = batch["items"]
+    counts = {state: 0 for state in BATCH_ICONS}
+    total = current = speed = 0
+    for item in items:
+        counts[item["state"]] += 1
+        if item["state"] == "cancelled":
+            continue
+        total += item["total"]
+        if item["state"] in ("done", "failed"):
+            current += item["total"]
+        else:
+            current += item["current"]
+        if item["state"] == "downloading":
+            speed += item["speed"]
+
+    finished = all(item["state"] not in ("queued", "downloading") for item in items)
+    if finished:
+        lines = [f"✅ **Lote completado — {len(items)} archivo(s)**\n"]
+    else:
+        lines = [
+            f"📦 **Lote — {len(items)} archivo(s)**",
+            f"`{progress_service.create_progress_bar(current, total)}`",
+            f"{file_service.format_bytes(current)} / {file_service.format_bytes(total)}"
+            f"  ·  {progress_service.format_speed(speed)}"
+            f"  ·  ETA {progress_service.calculate_eta(current, total, speed)}",
+        ]
+    lines.append(
+        "  ".join(f"{BATCH_ICONS[state]} {n}" for state, n in counts.items() if n) + "\n"
+    )
+
+    for item in items[:BATCH_MAX_LINES]:
+        name = item["job"].file_name
+        short = name[:37] + "..." if len(name) > 40 else name
+        icon = BATCH_ICONS[item["state"]]
+        # En cola o bajando el enlace ya sirve el archivo a medida que llega
+        active = item["state"] in ("queued", "downloading") and item["url"]
+        title = _link(short, item["url"]) if active else _esc(short)
+        if item["state"] == "done":
+            lines.append(f"{icon} #{item['number']} {_link(short, item['url'])}")
+        elif item["state"] == "downloading":
+            bar = progress_service.create_progress_bar(item["current"], item["total"], 10)
+            lines.append(f"{icon} {title}\n    `{bar}`")
+        else:
+            lines.append(f"{icon} {title}")
+    if len(items) > BATCH_MAX_LINES:
+        lines.append(f"... y {len(items) - BATCH_MAX_LINES} mas (/list)")
+    return "\n".join(lines)
+
+
 def _split_text(text: str, limit: int = 4000) -> list:
     chunks, current = [], ""
     for line in text.splitlines(keepends=True):
@@ -276,7 +445,7 @@ async def cmd_cd(client: Client, message: Message):
 
     if len(args) == 1:
         folder = session["current_folder"]
-        count = len(file_service.list_user_files(user_id, folder))
+        count = len(await async_files.list_user_files(user_id, folder))
         await message.reply_text(
             f"{_folder_icon(folder)} **{_folder_label(folder)}**\n"
             f"Tienes **{count}** archivo(s).",
@@ -295,7 +464,7 @@ async def cmd_cd(client: Client, message: Message):
         return
 
     session["current_folder"] = folder
-    count = len(file_service.list_user_files(user_id, folder))
+    count = len(await async_files.list_user_files(user_id, folder))
     await message.reply_text(
         f"{_folder_icon(folder)} **{_folder_label(folder)}**\n"
         f"Tienes **{count}** archivo(s).",
@@ -312,7 +481,7 @@ async def cmd_list(client: Client, message: Message):
     except ValueError:
         page = 1
 
-    files = file_service.list_user_files(user_id, folder)
+    files = await async_files.list_user_files(user_id, folder)
     if not files:
         await message.reply_text(
             f"📭 **{_folder_label(folder)}** esta vacia.\n\n"
@@ -351,7 +520,7 @@ async def cmd_delete(client: Client, message: Message):
         return
 
     target = next(
-        (f for f in file_service.list_user_files(user_id, folder) if f["number"] == num),
+        (f for f in await async_files.list_user_files(user_id, folder) if f["number"] == num),
         None,
     )
     if not target:
@@ -374,7 +543,7 @@ async def cmd_delete(client: Client, message: Message):
 async def cmd_clear(client: Client, message: Message):
     user_id = message.from_user.id
     folder = get_session(user_id)["current_folder"]
-    count = len(file_service.list_user_files(user_id, folder))
+    count = len(await async_files.list_user_files(user_id, folder))
 
     if count == 0:
         await message.reply_text(
@@ -415,12 +584,13 @@ async def cmd_rename(client: Client, message: Message):
         await message.reply_text("❌ El nuevo nombre no puede estar vacio.")
         return
 
-    success, msg, new_url = file_service.rename_file(user_id, num, new_name, folder)
+    success, msg, new_url = await async_files.rename_file(user_id, num, new_name, folder)
     if success:
         await message.reply_text(
             f"✅ **Archivo renombrado.**\n\n{_link(new_name, new_url)}",
             reply_markup=kb_back(),
-            disable_web_page_preview=False,
+            # La vista previa pediria el enlace y bajaria un archivo registrado
+            disable_web_page_preview=True,
         )
     else:
         await message.reply_text(f"❌ {msg}", reply_markup=kb_back())
@@ -429,7 +599,7 @@ async def cmd_rename(client: Client, message: Message):
 async def cmd_status(client: Client, message: Message):
     user_id = message.from_user.id
     await message.reply_text(
-        _build_status(user_id, get_session(user_id)),
+        await _build_status(user_id, get_session(user_id)),
         reply_markup=kb_main(),
     )
 
@@ -438,97 +608,203 @@ async def cmd_pack(client: Client, message: Message):
     user_id = message.from_user.id
     parts = message.text.split()
 
-    st = load_manager.get_status()
-    if not st["can_accept_work"]:
+    if user_id in active_packs:
         await message.reply_text(
-            "⚠️ **Servidor sobrecargado.**\n\n"
-            f"CPU: {st['cpu_percent']:.1f}%  |  Procesos: {st['active_processes']}\n\n"
-            "Intenta de nuevo en unos minutos.",
+            "⚠️ Ya tienes un empaquetado en cola o en curso. Usa /cancel para anularlo.",
             reply_markup=kb_main(),
         )
         return
 
-    split_size = None
-    if len(parts) > 1:
-        try:
-            split_size = int(parts[1])
+    options, error = _parse_pack_args(parts[1:])
+    if error:
+        await message.reply_text(error)
+        return
+
+    selection = None
+    if options["selection"]:
+        selection, error = await async_files.resolve_selection(
+            user_id, options["selection"], "downloads"
+        )
+        if error:
+            await message.reply_text(f"❌ {error}", reply_markup=kb_back())
+            return
+
+    split_size = options["split_size"]
+    fmt = options["format"]
+    detail = (
+        f"Dividiendo en partes de {split_size} MB..." if split_size
+        else f"Creando archivo {fmt.upper()}..."
+    )
+    if selection:
+        detail = f"{len(selection)} archivo(s) seleccionados. {detail}"
+    elif options["incremental"]:
+        detail = f"Modo incremental. {detail}"
+    status_msg = await message.reply_text(
+        f"⏳ **Empaquetando...**\n{detail}", reply_markup=kb_cancel_pack()
+    )
+
+    result_text, result_kb = await _run_pack(
+        user_id, split_size, options["incremental"], selection, fmt, status_msg, detail
+    )
+    await edit_scheduler.edit(
+        status_msg, result_text, reply_markup=result_kb, disable_web_page_preview=True
+    )
+    edit_scheduler.forget(status_msg)
+
+
+def _parse_pack_args(args: list) -> tuple:
+    """Interpreta `/pack [tar] [inc] [3,5-12 | #3] [MB]` en cualquier orden.
+
+    Un numero suelto es el tamaño de parte; un archivo suelto se indica con #.
+    """
+    options = {"incremental": False, "format": "zip", "selection": None, "split_size": None}
+    usage = (
+        "❌ Valor invalido.\n"
+        "Uso: `/pack [tar] [inc] [3,5-12] [MB]`\n"
+        "Ejemplos: `/pack 100`  |  `/pack #3`  |  `/pack 3,5-12`  |  `/pack tar 1-4 200`\n"
+        "Un numero solo es el tamaño de parte; para un archivo usa `#3`."
+    )
+    for arg in args:
+        low = arg.lower()
+        if low == "inc":
+            options["incremental"] = True
+        elif low in ("zip", "tar"):
+            options["format"] = low
+        elif low.startswith("#") or "," in low or "-" in low:
+            options["selection"] = low
+        else:
+            try:
+                split_size = int(low)
+            except ValueError:
+                return None, usage
             if not 1 <= split_size <= 500:
-                await message.reply_text(
+                return None, (
                     "❌ El tamaño de parte debe estar entre 1 y 500 MB.\n"
                     "Ejemplo: `/pack 100`"
                 )
-                return
-        except ValueError:
-            await message.reply_text("❌ Valor invalido.\nUso: `/pack`  o  `/pack MB`")
-            return
-
-    detail = f"Dividiendo en partes de {split_size} MB..." if split_size else "Creando archivo ZIP..."
-    status_msg = await message.reply_text(f"⏳ **Empaquetando...**\n{detail}")
-
-    result_text, result_kb = await _run_pack(user_id, split_size)
-    await status_msg.edit_text(result_text, reply_markup=result_kb, disable_web_page_preview=True)
+            options["split_size"] = split_size
+    return options, None
 
 
 async def cmd_queue(client: Client, message: Message):
     user_id = message.from_user.id
     queue = user_queues.get(user_id, [])
+    processing = user_processing.get(user_id, [])
 
-    if not queue:
+    if not queue and not processing:
         await message.reply_text(
             "📭 **Cola vacia.** No hay archivos pendientes.",
             reply_markup=kb_main(),
         )
         return
 
-    lines = [f"📋 **Cola — {len(queue)} archivo(s)**\n"]
-    for i, msg in enumerate(queue, 1):
-        if msg.document:
-            lbl = f"📄 {msg.document.file_name or 'sin nombre'}"
-        elif msg.video:
-            lbl = f"🎬 {msg.video.file_name or 'sin nombre'}"
-        elif msg.audio:
-            lbl = f"🎵 {msg.audio.file_name or 'sin nombre'}"
-        elif msg.photo:
-            lbl = "🖼 Foto"
-        else:
-            lbl = "📎 Archivo"
-        lines.append(f"#{i} — {lbl}")
+    lines = [f"📋 **Cola — {len(processing) + len(queue)} archivo(s)**\n"]
+    for i, job in enumerate(processing + queue, 1):
+        state = " ⏳" if i <= len(processing) else ""
+        lines.append(f"#{i} — {job.label}{state}")
 
-    if user_id in user_processing:
-        lines.append("\n⏳ Procesando el primero ahora...")
+    if processing:
+        lines.append(f"\n⏳ Procesando {len(processing)} ahora...")
     else:
         lines.append("\n⏸ En espera.")
 
+    sched = download_scheduler.get_status()
+    if sched["waiting"]:
+        lines.append(
+            f"Servidor: {sched['slots_in_use']}/{sched['max_slots']} descargas activas, "
+            f"{sched['waiting']} en espera (espera media {sched['avg_wait_s']:.0f}s)"
+        )
+
     await message.reply_text("\n".join(lines), reply_markup=kb_main())
 
 
 async def cmd_clearqueue(client: Client, message: Message):
     user_id = message.from_user.id
-    lock = get_queue_lock(user_id)
+    count = await _drop_queue(user_id)
+    # Tambien se detiene lo que se esta descargando ahora
+    running = _cancel_downloads(user_id)
+    if not count and not running:
+        await message.reply_text(
+            "📭 La cola ya esta vacia.",
+            reply_markup=kb_main(),
+        )
+        return
 
-    async with lock:
-        queue = user_queues.get(user_id, [])
-        if not queue:
-            await message.reply_text(
-                "📭 La cola ya esta vacia.",
-                reply_markup=kb_main(),
-            )
-            return
+    await _refresh_dashboard(user_id)
+
+    await message.reply_text(
+        f"🗑 **Cola limpiada.** Se cancelaron **{count + running}** archivo(s).",
+        reply_markup=kb_main(),
+    )
 
-        count = len(queue)
-        user_queues[user_id] = []
-        user_processing.pop(user_id, None)
 
+async def cmd_cancel(client: Client, message: Message):
+    user_id = message.from_user.id
+    downloads = _cancel_downloads(user_id)
+    pack = _cancel_pack(user_id)
+    if not downloads and not pack:
+        await message.reply_text(
+            "📭 No hay ninguna descarga ni empaquetado en curso.",
+            reply_markup=kb_main(),
+        )
+        return
+
+    what = []
+    if downloads:
+        what.append(f"{downloads} descarga(s)")
+    if pack:
+        what.append("el empaquetado")
+    remaining = len(user_queues.get(user_id, []))
+    queue_note = (
+        f"\n\nLa cola sigue con {remaining} archivo(s). Usa /clearqueue para vaciarla."
+        if remaining else ""
+    )
     await message.reply_text(
-        f"🗑 **Cola limpiada.** Se cancelaron **{count}** archivo(s).",
+        f"🚫 **Cancelando {' y '.join(what)}.**{queue_note}",
         reply_markup=kb_main(),
     )
 
 
+async def _drop_queue(user_id: int) -> int:
+    """Vacia la cola pendiente del usuario y devuelve cuantos quito."""
+    async with get_queue_lock(user_id):
+        queue = user_queues.pop(user_id, None) or []
+        for job in queue:
+            await _discard_queued(job)
+            disk_admission.release(job.key)
+            item = _batch_item(job)
+            if item is not None:
+                item["state"] = "cancelled"
+    return len(queue)
+
+
+def _cancel_download(job_key: tuple) -> bool:
+    """Cancela la tarea de una descarga en curso; su limpieza la hace la propia tarea."""
+    task = active_downloads.get(job_key)
+    if task is None or task.done():
+        return False
+    cancelled_jobs.add(job_key)
+    task.cancel()
+    return True
+
+
+def _cancel_downloads(user_id: int) -> int:
+    return sum(_cancel_download(job.key) for job in list(user_processing.get(user_id, [])))
+
+
+def _cancel_pack(user_id: int) -> bool:
+    """Pide al hilo de empaquetado que se detenga en el siguiente archivo o bloque."""
+    event = active_packs.get(user_id)
+    if event is None or event.is_set():
+        return False
+    event.set()
+    return True
+
+
 async def cmd_cleanup(client: Client, message: Message):
     status_msg = await message.reply_text("🧹 Analizando almacenamiento...")
     try:
-        mb = file_service.get_user_storage_usage(message.from_user.id) / (1024 * 1024)
+        mb = await async_files.get_user_storage_usage(message.from_user.id) / (1024 * 1024)
         await status_msg.edit_text(
             f"✅ **Analisis completado.**\n\n"
             f"Espacio ocupado: **{mb:.2f} MB**\n"
@@ -543,26 +819,162 @@ async def cmd_cleanup(client: Client, message: Message):
 #  LOGICA DE EMPAQUETADO
 # ─────────────────────────────────────────────
 
-async def _run_pack(user_id: int, split_size) -> tuple:
+async def _run_pack(user_id: int, split_size, incremental: bool = False,
+                    selection: list = None, archive_format: str = "zip",
+                    status_msg: Message = None, detail: str = "") -> tuple:
+    """Empaqueta cuando llega el turno del usuario en pack_scheduler.
+
+    Mientras espera, status_msg muestra la posicion en la cola y la
+    estimacion de inicio. Un resultado que ya esta en cache no hace cola.
+    """
+    loop = asyncio.get_running_loop()
+    cancel_event = threading.Event()
+    started = False
+
+    def _probe():
+        try:
+            return packing_service.probe(
+                user_id, split_size, incremental, selection, archive_format
+            )
+        except Exception as e:
+            logger.debug(f"No se pudo consultar la cache de empaquetado: {e}")
+            return None, 0
+
     def _do():
+        completed = False
         try:
-            return packing_service.pack_folder(user_id, split_size)
+            result = packing_service.pack_folder(
+                user_id, split_size, incremental, selection, archive_format, cancel_event
+            )
+            completed = bool(result[0])
+            return result
         except Exception as e:
             return None, str(e)
+        finally:
+            # El slot sigue ocupado hasta que el hilo termina de verdad
+            loop.call_soon_threadsafe(pack_scheduler.release, user_id, completed)
 
+    active_packs[user_id] = cancel_event
+    waiter = None
     try:
-        with concurrent.futures.ThreadPoolExecutor() as ex:
-            files, err_msg = ex.submit(_do).result(timeout=300)
-    except concurrent.futures.TimeoutError:
+        # Los archivos sin copia local (bajo demanda o expulsados) se bajan antes
+        missing = await _fetch_remote_inputs(user_id, selection, status_msg, detail)
+        if cancel_event.is_set():
+            return "🚫 **Empaquetado cancelado.**", kb_main()
+        if missing:
+            shown = ", ".join(f"#{n}" for n in missing[:10])
+            return (
+                f"❌ No se pudieron bajar de Telegram: {shown}\n"
+                "El paquete no se creo para no dejarlos fuera.",
+                kb_main(),
+            )
+
+        cached, size = await loop.run_in_executor(None, _probe)
+        if cached:
+            files, err_msg = cached
+        else:
+            waiter = pack_scheduler.enqueue(user_id, size)
+            await _wait_pack_turn(waiter, cancel_event, status_msg, detail)
+            if cancel_event.is_set():
+                return (
+                    "🚫 **Empaquetado cancelado.**\n\nSe retiro de la cola.",
+                    kb_main(),
+                )
+
+            # En un hilo aparte: el bucle de eventos sigue atendiendo /cancel
+            started = True
+            try:
+                files, err_msg = await asyncio.wait_for(
+                    loop.run_in_executor(None, _do), timeout=300
+                )
+            except asyncio.TimeoutError:
+                cancel_event.set()
+                return (
+                    "❌ **Tiempo agotado.**\n\n"
+                    "El empaquetado tardó demasiado. Intenta con menos archivos.",
+                    kb_main(),
+                )
+    finally:
+        if waiter is not None and not started:
+            pack_scheduler.withdraw(user_id, waiter)
+        if active_packs.get(user_id) is cancel_event:
+            active_packs.pop(user_id, None)
+
+    if cancel_event.is_set():
         return (
-            "❌ **Tiempo agotado.**\n\n"
-            "El empaquetado tardó demasiado. Intenta con menos archivos.",
+            "🚫 **Empaquetado cancelado.**\n\nSe borraron los archivos parciales.",
             kb_main(),
         )
 
     if not files:
         return f"❌ {err_msg}", kb_main()
 
+    return _build_pack_result(user_id, files)
+
+
+async def _fetch_remote_inputs(user_id: int, selection: list = None,
+                               status_msg: Message = None, detail: str = "") -> list:
+    """Baja de Telegram los archivos a empaquetar sin copia local.
+
+    Devuelve los numeros de los que no se pudieron bajar.
+    """
+    files = await async_files.list_user_files(user_id, "downloads")
+    remote = [
+        f for f in files
+        if f["remote"] and (selection is None or f["stored_name"] in selection)
+    ]
+    if not remote:
+        return []
+    if status_msg is not None:
+        edit_scheduler.request(
+            status_msg,
+            f"📥 **Bajando {len(remote)} archivo(s) de Telegram** antes de empaquetar...\n{detail}",
+            reply_markup=kb_cancel_pack(),
+        )
+    results = await asyncio.gather(
+        *(lazy_fetcher.fetch_local(user_id, f["stored_name"]) for f in remote),
+        return_exceptions=True,
+    )
+    missing = [f["number"] for f, ok in zip(remote, results) if ok is not True]
+    if status_msg is not None and not missing:
+        edit_scheduler.request(
+            status_msg, f"⏳ **Empaquetando...**\n{detail}", reply_markup=kb_cancel_pack()
+        )
+    return missing
+
+
+async def _wait_pack_turn(waiter: dict, cancel_event: threading.Event,
+                          status_msg: Message = None, detail: str = ""):
+    """Espera el slot de empaquetado o hasta que se cancele, avisando de la posicion."""
+    future = waiter["future"]
+    shown = False
+    next_update = 0.0
+    while not future.done() and not cancel_event.is_set():
+        now = time.monotonic()
+        position, eta = pack_scheduler.estimate(waiter)
+        if status_msg is not None and position and now >= next_update:
+            next_update = now + PACK_QUEUE_UPDATE_INTERVAL
+            start = (
+                f"Empieza en ~{progress_service.format_duration(eta)}" if eta >= 1
+                else "Empieza en breve"
+            )
+            edit_scheduler.request(
+                status_msg,
+                f"🕒 **En cola para empaquetar**\n"
+                f"Posicion: {position}  |  {start}\n{detail}",
+                reply_markup=kb_cancel_pack(),
+            )
+            shown = True
+        # /cancel solo activa el Event: se revisa a menudo
+        await asyncio.wait({future}, timeout=0.5)
+
+    if shown and not cancel_event.is_set():
+        edit_scheduler.request(
+            status_msg, f"⏳ **Empaquetando...**\n{detail}", reply_markup=kb_cancel_pack()
+        )
+
+
+def _build_pack_result(user_id: int, files: list) -> tuple:
     total_mb = sum(f["size_mb"] for f in files)
     orig = f" ({files[0]['total_files']} archivos)" if files[0].get("total_files") else ""
 
@@ -575,24 +987,30 @@ async def _run_pack(user_id: int, split_size) -> tuple:
         )
         return text, kb_after_pack()
 
-    # Buscar .txt de lista de partes
+    # Buscar lista de partes (.txt) y manifiestos (.json, .meta4)
     user_dir = file_service.get_user_directory(user_id, "packed")
     base = next(
         (f["filename"].rsplit(".", 2)[0] for f in files if ".001" in f["filename"]),
         None,
     )
-    list_url = None
+    index_links = []
     if base:
-        txt_path = os.path.join(user_dir, f"{base}.txt")
-        if os.path.exists(txt_path):
-            list_url = file_service.create_packed_url(user_id, f"{base}.txt")
+        for ext, label in (
+            ("txt", "Lista de partes (.txt)"),
+            ("json", "Manifiesto (.json)"),
+            ("meta4", "Metalink para aria2 (.meta4)"),
+        ):
+            if os.path.exists(os.path.join(user_dir, f"{base}.{ext}")):
+                url = file_service.create_packed_url(user_id, f"{base}.{ext}")
+                index_links.append(_link(label, url))
+    index_text = "\n".join(index_links)
 
     lines = [
         f"✅ **Empaquetado completado{orig}**\n",
         f"Partes: {len(files)}  |  Total: {total_mb:.1f} MB\n",
     ]
-    if list_url:
-        lines.append(f"\n{_link('Lista de partes (.txt)', list_url)}")
+    if index_text:
+        lines.append(f"\n{index_text}")
     lines.append("\n**Enlaces de descarga:**")
     for f in files:
         lines.append(f"\n{_link(f['filename'], f['url'])} — {f['size_mb']:.1f} MB")
@@ -604,7 +1022,7 @@ async def _run_pack(user_id: int, split_size) -> tuple:
             f"✅ **{len(files)} partes generadas{orig}**\n"
             f"Total: {total_mb:.1f} MB\n\n"
             "Usa el boton para ver los enlaces en tu carpeta packed."
-            + (f"\n\n{_link('Lista de partes (.txt)', list_url)}" if list_url else "")
+            + (f"\n\n{index_text}" if index_text else "")
         )
         return short, kb_after_pack()
 
@@ -637,7 +1055,7 @@ async def callback_handler(client: Client, query: CallbackQuery):
         elif data.startswith("cd:"):
             folder = data[3:]
             session["current_folder"] = folder
-            count = len(file_service.list_user_files(user_id, folder))
+            count = len(await async_files.list_user_files(user_id, folder))
             await query.message.edit_text(
                 f"{_folder_icon(folder)} **{_folder_label(folder)}**\n"
                 f"Tienes {count} archivo(s).",
@@ -647,7 +1065,7 @@ async def callback_handler(client: Client, query: CallbackQuery):
         elif data.startswith("list:"):
             page = int(data[5:])
             folder = session["current_folder"]
-            files = file_service.list_user_files(user_id, folder)
+            files = await async_files.list_user_files(user_id, folder)
 
             if not files:
                 await query.message.edit_text(
@@ -668,13 +1086,13 @@ async def callback_handler(client: Client, query: CallbackQuery):
 
         elif data == "status":
             await query.message.edit_text(
-                _build_status(user_id, session),
+                await _build_status(user_id, session),
                 reply_markup=kb_main(),
             )
 
         elif data.startswith("clear_confirm:"):
             folder = data[14:]
-            count = len(file_service.list_user_files(user_id, folder))
+            count = len(await async_files.list_user_files(user_id, folder))
             if count == 0:
                 await query.message.edit_text(
                     f"📭 **{_folder_label(folder)}** ya esta vacia.",
@@ -690,26 +1108,61 @@ async def callback_handler(client: Client, query: CallbackQuery):
 
         elif data.startswith("clear_do:"):
             folder = data[9:]
-            success, msg = file_service.delete_all_files(user_id, folder)
+            success, msg = await async_files.delete_all_files(user_id, folder)
+            if folder == "packed":
+                packing_service.evict_cached_results(user_id)
             icon = "✅" if success else "❌"
             await query.message.edit_text(f"{icon} {msg}", reply_markup=kb_folder(folder))
 
         elif data.startswith("delete_do:"):
             _, num_str, folder = data.split(":", 2)
-            success, msg = file_service.delete_file_by_number(user_id, int(num_str), folder)
+            target = await async_files.get_file_by_number(user_id, int(num_str), folder)
+            success, msg = await async_files.delete_file_by_number(user_id, int(num_str), folder)
+            if success and target and folder == "packed":
+                packing_service.evict_cached_results(user_id, target["stored_name"])
             icon = "✅" if success else "❌"
             await query.message.edit_text(f"{icon} {msg}", reply_markup=kb_back())
 
         elif data == "pack":
-            st = load_manager.get_status()
-            if not st["can_accept_work"]:
-                await query.answer("Servidor sobrecargado. Intenta mas tarde.", show_alert=True)
+            if user_id in active_packs:
+                await query.answer("Ya tienes un empaquetado en cola o en curso.", show_alert=True)
                 return
             await query.answer("Iniciando empaquetado...")
-            wait_msg = await query.message.reply_text("⏳ **Empaquetando...** Creando ZIP...")
-            result_text, result_kb = await _run_pack(user_id, None)
-            await wait_msg.edit_text(result_text, reply_markup=result_kb, disable_web_page_preview=True)
-            await query.answer()
+            wait_msg = await query.message.reply_text(
+                "⏳ **Empaquetando...**\nCreando archivo ZIP...", reply_markup=kb_cancel_pack()
+            )
+            result_text, result_kb = await _run_pack(
+                user_id, None, status_msg=wait_msg, detail="Creando archivo ZIP..."
+            )
+            await edit_scheduler.edit(
+                wait_msg, result_text, reply_markup=result_kb, disable_web_page_preview=True
+            )
+            edit_scheduler.forget(wait_msg)
+            return
+
+        elif data.startswith("cancel_dl:"):
+            _, chat_id, message_id = data.split(":", 2)
+            key = (int(chat_id), int(message_id))
+            job = next((j for j in user_processing.get(user_id, []) if j.key == key), None)
+            if job is None or not _cancel_download(key):
+                await query.answer("Esa descarga ya no esta en curso.")
+                return
+            await query.answer("Cancelando descarga...")
+            return
+
+        elif data == "cancel_batch":
+            count = await _drop_queue(user_id) + _cancel_downloads(user_id)
+            await _refresh_dashboard(user_id)
+            await query.answer(
+                f"Cancelando {count} archivo(s)..." if count else "El lote ya termino."
+            )
+            return
+
+        elif data == "cancel_pack":
+            if not _cancel_pack(user_id):
+                await query.answer("No hay ningun empaquetado en curso.")
+                return
+            await query.answer("Cancelando empaquetado...")
             return
 
         else:
@@ -730,35 +1183,44 @@ async def callback_handler(client: Client, query: CallbackQuery):
 #  RECEPCION Y COLA DE ARCHIVOS
 # ─────────────────────────────────────────────
 
-def _get_file_info(message: Message):
-    """Extrae tipo, nombre y tamaño del archivo del mensaje."""
-    if message.document:
-        return "Documento", message.document.file_name or "archivo", message.document.file_size or 0
-    if message.video:
-        return "Video", message.video.file_name or "video.mp4", message.video.file_size or 0
-    if message.audio:
-        return "Audio", message.audio.file_name or "audio.mp3", message.audio.file_size or 0
-    if message.photo:
-        return "Foto", f"foto_{message.id}.jpg", message.photo[-1].file_size or 0
-    return None, None, 0
-
-
 async def handle_file(client: Client, message: Message):
     """Recibe un archivo y lo encola para procesamiento."""
-    user_id = message.from_user.id
+    # Los albumes llegan como varios mensajes: se agrupan antes de encolar
+    if message.media_group_id:
+        _buffer_album(client, message)
+        return
 
-    file_type, orig_name, file_size = _get_file_info(message)
-    if not file_type:
+    job = DownloadJob.from_message(message)
+    if not job:
         return
+    await _accept_jobs(client, message, [job])
+
+
+async def _accept_jobs(client: Client, message: Message, jobs: list, album: bool = False):
+    """Valida y encola uno o varios archivos recibidos juntos."""
+    user_id = message.from_user.id
 
     # Validar tamaño
-    if file_size > MAX_FILE_SIZE:
+    too_big = [job for job in jobs if job.file_size > MAX_FILE_SIZE]
+    jobs = [job for job in jobs if job.file_size <= MAX_FILE_SIZE]
+    if too_big and not album:
         await message.reply_text(
             f"❌ **Archivo demasiado grande.**\n\n"
-            f"Tu archivo: {file_service.format_bytes(file_size)}\n"
+            f"Tu archivo: {file_service.format_bytes(too_big[0].file_size)}\n"
             f"Limite: {MAX_FILE_SIZE_MB} MB\n\n"
             "Dividelo en partes mas pequenas."
         )
+    elif too_big:
+        names = "\n".join(f"• {_esc(job.file_name)}" for job in too_big)
+        await message.reply_text(
+            f"❌ **{len(too_big)} archivo(s) del album superan {MAX_FILE_SIZE_MB} MB:**\n{names}"
+        )
+    if not jobs:
+        return
+
+    # Modo bajo demanda: sin cola ni descarga, el enlace se sirve al abrirlo
+    if LAZY_DOWNLOADS and all(job.file_size > 0 for job in jobs):
+        await _register_lazy(message, jobs)
         return
 
     lock = get_queue_lock(user_id)
@@ -768,9 +1230,10 @@ async def handle_file(client: Client, message: Message):
             user_queues[user_id] = []
 
         current_len = len(user_queues[user_id])
+        capacity = MAX_QUEUE_PER_USER - current_len
 
         # Limitar cola por usuario
-        if current_len >= MAX_QUEUE_PER_USER:
+        if capacity <= 0:
             await message.reply_text(
                 f"❌ **Cola llena.**\n\n"
                 f"Maximo {MAX_QUEUE_PER_USER} archivos en cola.\n"
@@ -778,104 +1241,402 @@ async def handle_file(client: Client, message: Message):
             )
             return
 
-        user_queues[user_id].append(message)
-        pos = current_len + 1
+        accepted, rejected = jobs[:capacity], max(0, len(jobs) - capacity)
 
-    if pos == 1:
-        asyncio.create_task(_process_queue(client, user_id))
-    else:
+        # Reservar espacio en disco (y cuota) antes de aceptar cada archivo
+        no_space = []
+        for job in list(accepted):
+            # La cuota recorre las carpetas del usuario: fuera del bucle
+            ok, reason, _ = await async_files.run(
+                user_id, disk_admission.reserve, user_id, job.key, job.file_size
+            )
+            if not ok:
+                accepted.remove(job)
+                no_space.append((job, reason))
+
+        pos = len(user_processing.get(user_id, [])) + current_len + 1
+        # Con mas de un archivo pendiente se usa un unico mensaje de lote
+        batch = user_batches.get(user_id)
+        new_batch = bool(accepted) and batch is None and (pos > 1 or len(accepted) > 1)
+        if new_batch:
+            batch = user_batches[user_id] = {"message": None, "items": []}
+
+        # En la cola solo queda el DownloadJob, no el Message completo
+        for job in accepted:
+            stored = None
+            if batch is not None:
+                item = _new_batch_item(job)
+                if job.file_size > 0:
+                    # Se aparta ya su archivo en staging: el enlace del panel
+                    # sirve el archivo en cuanto empiece a bajar
+                    stored, path = await async_files.run(
+                        user_id, _stage_download, user_id, job.file_name
+                    )
+                    download_service.begin_partial(path, job.file_size)
+                    item["url"] = file_service.create_download_url(user_id, stored)
+                batch["items"].append(item)
+            user_queues[user_id].append(job)
+            await async_files.run(user_id, job_store.add, job, stored)
+        _spawn_workers(client, user_id)
+
+    if no_space:
+        if len(no_space) == 1 and not album:
+            await message.reply_text(f"❌ **Archivo rechazado.**\n\n{no_space[0][1]}.")
+        else:
+            names = "\n".join(f"• {_esc(job.file_name)}" for job, _ in no_space)
+            await message.reply_text(
+                f"❌ **{len(no_space)} archivo(s) rechazados.**\n{no_space[0][1]}.\n\n{names}"
+            )
+    if rejected > 0:
         await message.reply_text(
-            f"📬 **Archivo encolado.**\n"
-            f"Posicion: #{pos} — espera tu turno."
+            f"❌ **Cola llena.** {rejected} archivo(s) no se encolaron "
+            f"(maximo {MAX_QUEUE_PER_USER})."
         )
+    if new_batch:
+        try:
+            batch["message"] = await message.reply_text(
+                _build_dashboard(batch), reply_markup=kb_cancel_batch(),
+                disable_web_page_preview=True,
+            )
+        except Exception as e:
+            # Sin mensaje de lote los archivos que falten usan su propio mensaje
+            logger.warning(f"No se pudo enviar el panel del lote de {user_id}: {e}")
+            if user_batches.get(user_id) is batch:
+                user_batches.pop(user_id, None)
+            return
+    await _refresh_dashboard(user_id)
 
 
-async def _process_queue(client: Client, user_id: int):
-    """Procesa la cola de archivos de un usuario de forma secuencial."""
-    lock = get_queue_lock(user_id)
-
-    while True:
-        async with lock:
-            if not user_queues.get(user_id):
-                user_processing.pop(user_id, None)
-                return
-            msg = user_queues[user_id][0]
+def _buffer_album(client: Client, message: Message):
+    """Acumula los mensajes de un album durante ALBUM_WINDOW segundos."""
+    key = (message.chat.id, message.media_group_id)
+    done = album_done.get(key)
+    if done and message.id in done[1]:
+        return
 
-        total_in_queue = len(user_queues[user_id])
-        user_processing[user_id] = True
+    buffer = album_buffers.get(key)
+    if buffer is None:
+        buffer = album_buffers[key] = {"messages": []}
+        asyncio.create_task(_flush_album(client, key))
+    buffer["messages"].append(message)
 
-        await _process_single_file(client, msg, user_id, total_in_queue)
 
-        async with lock:
-            if user_queues.get(user_id):
-                user_queues[user_id].pop(0)
+async def _flush_album(client: Client, key: tuple):
+    """Resuelve el album completo con una sola llamada y lo encola como lote."""
+    await asyncio.sleep(ALBUM_WINDOW)
+    buffer = album_buffers.pop(key, None)
+    if not buffer:
+        return
+    first = min(buffer["messages"], key=lambda m: m.id)
+    done = album_done.get(key, (0, set()))[1]
 
-        await asyncio.sleep(QUEUE_PROCESSING_DELAY)
+    try:
+        messages = await client.get_media_group(key[0], first.id)
+    except Exception as e:
+        logger.warning(f"get_media_group fallo para el album {key[1]}: {e}")
+        messages = buffer["messages"]
 
+    messages = sorted(
+        (m for m in messages if m.id not in done), key=lambda m: m.id
+    )
+    now = time.time()
+    for old_key, (at, _) in list(album_done.items()):
+        if now - at > ALBUM_DONE_TTL:
+            album_done.pop(old_key, None)
+    album_done[key] = (now, done | {m.id for m in messages})
+
+    jobs = [job for job in (DownloadJob.from_message(m) for m in messages) if job]
+    if jobs:
+        await _accept_jobs(client, first, jobs, album=True)
+
+
+def _new_batch_item(job: DownloadJob) -> dict:
+    return {
+        "job": job, "state": "queued", "current": 0, "total": job.file_size,
+        "speed": 0.0, "url": None, "number": None,
+    }
+
+
+def _batch_item(job: DownloadJob):
+    batch = user_batches.get(job.user_id)
+    if not batch:
+        return None
+    return next((item for item in batch["items"] if item["job"] is job), None)
+
+
+async def _discard_queued(job: DownloadJob):
+    """Olvida un trabajo en cola y el archivo que tuviera apartado en staging."""
+    user_id = job.user_id
+    record = await async_files.run(user_id, job_store.get, job.chat_id, job.message_id)
+    if record and record["stored_name"]:
+        stored = record["stored_name"]
+        download_service.end_partial(file_service.get_staging_path(user_id, stored), False)
+        await async_files.run(user_id, _rollback_file, user_id, stored)
+    await async_files.run(user_id, job_store.remove, job.chat_id, job.message_id)
+
+
+async def _refresh_dashboard(user_id: int):
+    """Programa la edicion del lote; al terminar todo, envia el resumen final."""
+    batch = user_batches.get(user_id)
+    if not batch or not batch["message"]:
+        return
+    text = _build_dashboard(batch)
+    if any(item["state"] in ("queued", "downloading") for item in batch["items"]):
+        edit_scheduler.request(
+            batch["message"], text, reply_markup=kb_cancel_batch(),
+            disable_web_page_preview=True,
+        )
+        return
 
-async def _process_single_file(client, message, user_id, total):
-    """Descarga y registra un unico archivo."""
-    start = time.time()
+    user_batches.pop(user_id, None)
+    edit_scheduler.finish(
+        batch["message"], text, reply_markup=kb_after_upload(), disable_web_page_preview=True
+    )
 
-    file_type, orig_name, file_size = _get_file_info(message)
-    if not file_type:
-        return
 
-    # Preparar ruta de almacenamiento
+def _reserve_name(user_id: int, orig_name: str) -> str:
+    """Elige un stored_name libre en disco, en staging y en el registro."""
     user_dir = file_service.get_user_directory(user_id, "downloads")
     sanitized = file_service.sanitize_filename(orig_name)
     stored = sanitized
-    path = os.path.join(user_dir, stored)
     base, ext = os.path.splitext(sanitized)
     c = 1
-    while os.path.exists(path):
+    while (
+        os.path.exists(os.path.join(user_dir, stored))
+        or file_service.is_stored_name_used(user_id, stored)
+    ):
         stored = f"{base}_{c}{ext}"
-        path = os.path.join(user_dir, stored)
         c += 1
+    return stored
 
-    # Registrar antes de descargar
-    file_number = file_service.register_file(user_id, orig_name, stored, "downloads")
 
-    # Mensaje de progreso
-    position = 1  # Siempre es el primero de la cola actual
-    prog_msg = await message.reply_text(
-        progress_service.create_progress_message(
-            filename=orig_name, current=0, total=file_size, speed=0,
-            user_first_name=message.from_user.first_name,
-            process_type="Descargando", current_file=position, total_files=total,
+def _register_ref(job: DownloadJob) -> tuple:
+    """Reserva nombre y registra el archivo solo por referencia (en el pool de E/S)."""
+    stored = _reserve_name(job.user_id, job.file_name)
+    file_number = file_service.register_file(
+        job.user_id, job.file_name, stored, "downloads", _telegram_ref(job)
+    )
+    return stored, file_number
+
+
+def _stage_download(user_id: int, orig_name: str, stored: str = None) -> tuple:
+    """(stored_name, ruta en staging): reanuda el parcial o reserva uno nuevo."""
+    if stored and os.path.exists(file_service.get_staging_path(user_id, stored)):
+        return stored, file_service.get_staging_path(user_id, stored)
+    stored = _reserve_name(user_id, orig_name)
+    return stored, file_service.create_staged(user_id, stored)
+
+
+def _telegram_ref(job: DownloadJob) -> dict:
+    """Datos para volver a pedir el archivo a Telegram mas tarde."""
+    return {
+        "chat_id": job.chat_id,
+        "message_id": job.message_id,
+        "size": job.file_size,
+    }
+
+
+async def _register_lazy(message: Message, jobs: list):
+    """Registra los archivos solo por referencia y responde con los enlaces."""
+    lines = []
+    for job in jobs:
+        stored, file_number = await async_files.run(job.user_id, _register_ref, job)
+        url = file_service.create_download_url(job.user_id, stored)
+        lines.append((file_number, job, url))
+
+    if len(lines) == 1:
+        file_number, job, url = lines[0]
+        text = (
+            f"✅ **Archivo registrado — #{file_number}**\n\n"
+            f"{_link(job.file_name, url)}\n"
+            f"{job.kind}  ·  {job.file_size / (1024 * 1024):.2f} MB  ·  downloads\n\n"
         )
+    else:
+        text = f"✅ **{len(lines)} archivos registrados**\n\n" + "".join(
+            f"#{file_number} {_link(job.file_name, url)}\n" for file_number, job, url in lines
+        ) + "\n"
+    await message.reply_text(
+        text + "Se descargara de Telegram la primera vez que se abra el enlace.",
+        reply_markup=kb_after_upload(),
+        disable_web_page_preview=True,
     )
 
-    pdata = {"last_update": 0.0, "last_speed": 0.0}
+
+def _spawn_workers(client: Client, user_id: int):
+    """Lanza workers de cola hasta MAX_DOWNLOADS_PER_USER (llamar con el lock tomado)."""
+    running = user_workers.get(user_id, 0)
+    needed = min(MAX_DOWNLOADS_PER_USER - running, len(user_queues.get(user_id, [])))
+    for _ in range(max(0, needed)):
+        user_workers[user_id] = user_workers.get(user_id, 0) + 1
+        asyncio.create_task(_process_queue(client, user_id))
+
+
+async def _process_queue(client: Client, user_id: int):
+    """Worker que toma archivos de la cola del usuario uno a uno.
+
+    La concurrencia global la decide download_scheduler; cada worker solo
+    descarga cuando obtiene un slot.
+    """
+    lock = get_queue_lock(user_id)
+
+    while True:
+        async with lock:
+            queue = user_queues.get(user_id)
+            if not queue:
+                user_queues.pop(user_id, None)
+                user_workers[user_id] = user_workers.get(user_id, 1) - 1
+                if user_workers[user_id] <= 0:
+                    user_workers.pop(user_id, None)
+                return
+            job = queue.pop(0)
+            processing = user_processing.setdefault(user_id, [])
+            processing.append(job)
+            total_in_queue = len(processing) + len(queue)
+
+        finished = False
+        task = asyncio.ensure_future(_process_single_file(client, job, total_in_queue))
+        active_downloads[job.key] = task
+        try:
+            await task
+            finished = True
+        except asyncio.CancelledError:
+            # Cancelada por el usuario: el worker sigue con la cola
+            if job.key not in cancelled_jobs:
+                raise
+            finished = True
+        except Exception as e:
+            logger.error(f"Error procesando archivo de {user_id}: {e}", exc_info=True)
+            finished = True
+        finally:
+            active_downloads.pop(job.key, None)
+            cancelled_jobs.discard(job.key)
+            disk_admission.release(job.key)
+            # Si se cancela (apagado) el trabajo queda guardado para recuperarlo
+            if finished:
+                await async_files.run(user_id, job_store.remove, job.chat_id, job.message_id)
+            async with lock:
+                processing = user_processing.get(user_id, [])
+                if job in processing:
+                    processing.remove(job)
+                if not processing:
+                    user_processing.pop(user_id, None)
+
+        await asyncio.sleep(QUEUE_PROCESSING_DELAY)
+
+
+async def _process_single_file(client, job, total):
+    """Descarga y registra un unico archivo."""
+    start = time.time()
+    user_id = job.user_id
+    orig_name, file_size = job.file_name, job.file_size
+
+    # Se descarga en staging y solo se registra al terminar. Un trabajo
+    # recuperado tras un reinicio continua sobre su archivo parcial.
+    record = await async_files.run(user_id, job_store.get, job.chat_id, job.message_id)
+    previous = record["stored_name"] if record else None
+    stored, path = await async_files.run(user_id, _stage_download, user_id, orig_name, previous)
+    if stored != previous or record["status"] != "active":
+        await async_files.run(
+            user_id, job_store.mark_active, job.chat_id, job.message_id, stored
+        )
+    url = file_service.create_download_url(user_id, stored)
+
+    # Con tamaño conocido el enlace funciona desde ya: se sirve mientras baja
+    download_service.begin_partial(path, file_size)
+    link_note = (
+        f"\n\n🔗 {_link(orig_name, url)}\nYa disponible mientras se descarga."
+        if file_size > 0 else ""
+    )
+
+    position = 1  # Siempre es el primero de la cola actual
+    item = _batch_item(job)
+    if item is not None and file_size > 0:
+        item["url"] = url
+    prog_msg = None
+    pdata = {"last_speed": 0.0}
 
     async def on_progress(current, total_bytes):
+        # edit_scheduler decide cuando se envia; aqui solo se genera el texto
         try:
             elapsed = time.time() - start
             speed = current / elapsed if elapsed > 0 else 0
             pdata["last_speed"] = 0.7 * pdata["last_speed"] + 0.3 * speed
-            now = time.time()
-            if now - pdata["last_update"] >= 0.6 or current == total_bytes:
-                txt = progress_service.create_progress_message(
-                    filename=orig_name, current=current, total=total_bytes,
-                    speed=pdata["last_speed"],
-                    user_first_name=message.from_user.first_name,
-                    process_type="Descargando",
-                    current_file=position, total_files=total,
-                )
-                try:
-                    await prog_msg.edit_text(txt)
-                    pdata["last_update"] = now
-                except Exception:
-                    pass
+            if item is not None:
+                item.update(state="downloading", current=current, speed=pdata["last_speed"])
+                await _refresh_dashboard(user_id)
+                return
+            txt = progress_service.create_progress_message(
+                filename=orig_name, current=current, total=total_bytes,
+                speed=pdata["last_speed"],
+                user_first_name=job.first_name,
+                process_type="Descargando",
+                current_file=position, total_files=total,
+            ) + link_note
+            edit_scheduler.request(
+                prog_msg, txt, reply_markup=kb_cancel_download(job),
+                disable_web_page_preview=True,
+            )
         except Exception:
             pass
 
-    success, _ = await download_service.download_with_retry(
-        client=client, message=message, file_path=path, progress_callback=on_progress,
-    )
+    success = False
+    try:
+        # Mensaje de progreso propio, salvo que el archivo vaya en un lote
+        if item is None:
+            prog_msg = await client.send_message(
+                job.chat_id,
+                progress_service.create_progress_message(
+                    filename=orig_name, current=0, total=file_size, speed=0,
+                    user_first_name=job.first_name,
+                    process_type="Descargando", current_file=position, total_files=total,
+                ) + link_note,
+                reply_to_message_id=job.message_id,
+                reply_markup=kb_cancel_download(job),
+                disable_web_page_preview=True,
+            )
 
-    if not success or not os.path.exists(path):
-        await prog_msg.edit_text(
+        async with download_scheduler.slot(user_id, file_size):
+            start = time.time()
+            if item is not None:
+                item["state"] = "downloading"
+                await _refresh_dashboard(user_id)
+            ok, _ = await download_service.download_with_retry(
+                client=client, job=job, file_path=path, progress_callback=on_progress,
+            )
+        if ok:
+            final_size = await async_files.run(user_id, os.path.getsize, path)
+            # Pasa a downloads con un rename atomico y se registra de una vez
+            final_num = await async_files.commit_staged(
+                user_id, stored, orig_name, _telegram_ref(job)
+            )
+            success = True
+    except asyncio.CancelledError:
+        # Cancelada con /cancel: el slot ya se libero al salir; se deshace todo
+        if job.key in cancelled_jobs:
+            download_service.end_partial(path, False)
+            await async_files.run(user_id, _rollback_file, user_id, stored)
+            logger.info(f"Descarga cancelada por el usuario {user_id}: {stored}")
+            if item is not None:
+                item["state"] = "cancelled"
+                await _refresh_dashboard(user_id)
+            elif prog_msg is not None:
+                edit_scheduler.request(
+                    prog_msg,
+                    f"🚫 **Descarga cancelada.**\n\n{_esc(orig_name)}",
+                    reply_markup=kb_main(),
+                )
+        raise
+    finally:
+        download_service.end_partial(path, success)
+
+    if not success:
+        await async_files.run(user_id, _rollback_file, user_id, stored)
+        if item is not None:
+            item["state"] = "failed"
+            await _refresh_dashboard(user_id)
+            return
+        edit_scheduler.finish(
+            prog_msg,
             "❌ **Error al descargar el archivo.**\n\n"
             "Intentalo de nuevo.",
             reply_markup=kb_main(),
@@ -883,36 +1644,126 @@ async def _process_single_file(client, message, user_id, total):
         return
 
     # Verificar integridad
-    final_size = os.path.getsize(path)
     if file_size > 0 and final_size < file_size * 0.95:
         logger.warning(f"Descarga posiblemente incompleta: {file_size}B -> {final_size}B")
 
     size_mb = final_size / (1024 * 1024)
-    url = file_service.create_download_url(user_id, stored)
 
-    # Obtener numero final correcto
-    files_list = file_service.list_user_files(user_id, "downloads")
-    final_num = next(
-        (f["number"] for f in files_list if f["stored_name"] == stored),
-        file_number,
-    )
+    if item is not None:
+        item.update(state="done", current=file_size, url=url, number=final_num)
+        await _refresh_dashboard(user_id)
+        return
 
     lock = get_queue_lock(user_id)
     async with lock:
-        remaining = len(user_queues.get(user_id, [])) - 1
+        remaining = len(user_queues.get(user_id, []))
 
     queue_note = f"\n\n⏳ Proximo en cola: {remaining} restante(s)..." if remaining > 0 else ""
 
-    await prog_msg.edit_text(
+    edit_scheduler.finish(
+        prog_msg,
         f"✅ **Archivo guardado — #{final_num}**\n\n"
         f"{_link(orig_name, url)}\n"
-        f"{file_type}  ·  {size_mb:.2f} MB  ·  downloads"
+        f"{job.kind}  ·  {size_mb:.2f} MB  ·  downloads"
         f"{queue_note}",
         reply_markup=kb_after_upload(),
         disable_web_page_preview=False,
     )
 
 
+async def recover_jobs(client: Client):
+    """Vuelve a encolar los trabajos guardados antes de un reinicio.
+
+    Los activos van primero y reanudan desde su checkpoint. El file_id
+    guardado lleva una file_reference que caduca, asi que se vuelven a
+    pedir los mensajes para renovarlo; si Telegram no responde se intenta
+    con el guardado.
+    """
+    rows = job_store.all_jobs()
+    # Lo que quede en staging sin trabajo que lo reanude ya no sirve
+    file_service.clean_staging(
+        (row["user_id"], row["stored_name"]) for row in rows if row["stored_name"]
+    )
+    if not rows:
+        return
+
+    recovered = {}
+    for row in rows:
+        if row["stored_name"] and await async_files.run(
+            row["user_id"], _finish_committed, row
+        ):
+            continue
+        file_id = await _refresh_file_id(client, row)
+        if not file_id:
+            await async_files.run(row["user_id"], _discard_job, row)
+            continue
+
+        job = DownloadJob.from_row(dict(row, file_id=file_id))
+        # Ya estaba aceptado: se reserva sin volver a comprobar
+        disk_admission.reserve(job.user_id, job.key, job.file_size, force=True)
+        async with get_queue_lock(job.user_id):
+            user_queues.setdefault(job.user_id, []).append(job)
+            _spawn_workers(client, job.user_id)
+        recovered[job.chat_id] = recovered.get(job.chat_id, 0) + 1
+
+    logger.info(
+        f"Cola recuperada: {sum(recovered.values())} de {len(rows)} trabajos"
+    )
+    for chat_id, count in recovered.items():
+        try:
+            await client.send_message(
+                chat_id, f"🔄 **Reanudando {count} archivo(s)** tras un reinicio del servidor."
+            )
+        except Exception:
+            pass
+
+
+async def _refresh_file_id(client: Client, row: dict):
+    """file_id actual del mensaje del trabajo, o None si el mensaje ya no existe."""
+    try:
+        message = await client.get_messages(row["chat_id"], row["message_id"])
+        fresh = DownloadJob.from_message(message) if message and not message.empty else None
+    except Exception as e:
+        logger.warning(f"No se pudo recuperar el mensaje {row['message_id']}: {e}")
+        return row["file_id"]
+
+    if fresh is None or fresh.file_unique_id != (row["file_unique_id"] or fresh.file_unique_id):
+        return None
+    if fresh.file_id != row["file_id"]:
+        await async_files.run(
+            row["user_id"], job_store.update_file_id,
+            row["chat_id"], row["message_id"], fresh.file_id,
+        )
+    return fresh.file_id
+
+
+def _discard_job(row: dict):
+    """Limpia un trabajo que no se puede recuperar."""
+    if row["stored_name"]:
+        _rollback_file(row["user_id"], row["stored_name"])
+    job_store.remove(row["chat_id"], row["message_id"])
+
+
+def _rollback_file(user_id: int, stored: str):
+    """Borra el archivo parcial de staging y su checkpoint (aun no hay registro)."""
+    path = file_service.get_staging_path(user_id, stored)
+    download_service.discard_checkpoint(path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _finish_committed(row: dict) -> bool:
+    """Completa un trabajo que llego a moverse a downloads antes del reinicio."""
+    user_id, stored = row["user_id"], row["stored_name"]
+    final = os.path.join(file_service.get_user_directory(user_id, "downloads"), stored)
+    if os.path.exists(file_service.get_staging_path(user_id, stored)) or not os.path.exists(final):
+        return False
+    job = DownloadJob.from_row(row)
+    file_service.commit_staged(user_id, stored, job.file_name, _telegram_ref(job))
+    job_store.remove(job.chat_id, job.message_id)
+    return True
+
+
 # ─────────────────────────────────────────────
 #  REGISTRO DE HANDLERS
 # ─────────────────────────────────────────────
@@ -929,6 +1780,7 @@ def setup_handlers(client: Client):
     client.on_message(filters.command("pack") & filters.private)(cmd_pack)
     client.on_message(filters.command("queue") & filters.private)(cmd_queue)
     client.on_message(filters.command("clearqueue") & filters.private)(cmd_clearqueue)
+    client.on_message(filters.command("cancel") & filters.private)(cmd_cancel)
     client.on_message(filters.command("cleanup") & filters.private)(cmd_cleanup)
 
     client.on_callback_query()(callback_handler)